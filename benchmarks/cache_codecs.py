@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compare cache codecs on payloads shaped like the ones the viewer caches
+
+Run from the repository root:
+    CACHE_TYPE=memory python3 benchmarks/cache_codecs.py
+"""
+
+import os
+import sys
+import timeit
+from base64 import b64encode
+
+import numpy as np
+from astropy import units
+from astropy.table import Table, MaskedColumn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache  # noqa: E402
+
+
+RNG = np.random.default_rng(0)
+
+
+def light_curve(n_obs=2000, oid=680113300005170):
+    mjd = np.sort(RNG.uniform(58194, 58664, n_obs))
+    return {
+        'meta': {
+            'nobs': n_obs, 'ngoodobs': n_obs, 'filter': 'zr', 'fieldid': 680, 'rcid': 45,
+            'coord': {'ra': 245.87, 'dec': 28.83}, 'duration': float(mjd[-1] - mjd[0]),
+        },
+        'lc': [
+            dict(mjd=float(t), mag=float(RNG.normal(15, 0.3)), magerr=float(RNG.uniform(0.01, 0.05)),
+                 clrcoeff=float(RNG.normal(0.1, 0.01)))
+            for t in mjd
+        ],
+        'oid': oid,
+    }
+
+
+def circle(n_objects=20, n_obs=500):
+    return {str(680113300005170 + i): dict(light_curve(n_obs), separation=float(RNG.uniform(0, 10)))
+            for i in range(n_objects)}
+
+
+def vizier_table(n_rows=500):
+    table = Table()
+    table['VSX'] = [f'V{i:07d} Her' for i in range(n_rows)]
+    table['RAJ2000'] = RNG.uniform(0, 360, n_rows)
+    table['DEJ2000'] = RNG.uniform(-30, 90, n_rows)
+    table['Period'] = MaskedColumn(RNG.uniform(0.1, 100, n_rows), mask=RNG.uniform(size=n_rows) < 0.3)
+    table['Type'] = RNG.choice(['EA', 'EW', 'RRAB', 'SR', 'MISC'], n_rows)
+    table['separation'] = RNG.uniform(0, 10, n_rows) * units.arcsec
+    table['__objname'] = table['VSX']
+    table['__link'] = [f'<a href="//www.aavso.org/vsx/index.php?view=detail.top&oid={i}">{i}</a>'
+                       for i in range(n_rows)]
+    return table
+
+
+def ogle_table(n_rows=5, image_bytes=30_000):
+    table = vizier_table(n_rows)
+    table['light_curve'] = [
+        f'<img src="data:image/png;base64,{b64encode(RNG.bytes(image_bytes)).decode()}" width=200px />'
+        for _ in range(n_rows)
+    ]
+    return table
+
+
+PAYLOADS = {
+    'FindZTFOID.find, 2000 obs': light_curve(),
+    'FindZTFCircle.find, 20x500 obs': circle(),
+    '_CatalogQuery.find, 500 rows': vizier_table(),
+    'OGLEQuery.find, 5 rows with images': ogle_table(),
+}
+
+SETUPS = {
+    'pickle': dict(codecs=[cache.PickleCodec], compression=cache.NoCompression),
+    'pickle+zlib': dict(codecs=[cache.PickleCodec], compression=cache.ZlibCompression),
+    'pickle+default': dict(codecs=[cache.PickleCodec], compression=cache.COMPRESSION),
+    'default': dict(codecs=cache.CODECS, compression=cache.COMPRESSION),
+}
+
+
+def main():
+    print(f'Default compression: {type(cache.COMPRESSION).__name__}')
+    for payload_name, payload in PAYLOADS.items():
+        print(f'\n{payload_name}')
+        print(f'{"codec":>20} {"size, KiB":>10} {"encode, ms":>11} {"decode, ms":>11}')
+        for setup_name, kwargs in SETUPS.items():
+            data = cache.encode(payload, **kwargs)
+            timer = timeit.Timer(lambda: cache.encode(payload, **kwargs))
+            n, t = timer.autorange()
+            encode_ms = t / n * 1e3
+            timer = timeit.Timer(lambda: cache.decode(data))
+            n, t = timer.autorange()
+            decode_ms = t / n * 1e3
+            print(f'{setup_name:>20} {len(data) / 1024:10.1f} {encode_ms:11.3f} {decode_ms:11.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Compare row-wise and column-wise derivation of the additional catalog columns
+
+Run from the repository root:
+    CACHE_TYPE=memory python3 benchmarks/catalog_columns.py
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+from astropy import units
+from astropy.table import Table, MaskedColumn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cross import ASTROCATS_QUERY, COSMO, LUMINOSITY_DISTANCE, SIMBAD_QUERY  # noqa: E402
+from util import to_str, to_str_column  # noqa: E402
+
+
+RNG = np.random.default_rng(0)
+
+
+def vizier_table(n_rows):
+    table = Table()
+    table['Name'] = [f'V{i:07d} Her'.encode() for i in range(n_rows)]
+    table['Type'] = RNG.choice(['EA', 'EW', 'RRAB', 'SR', 'MISC'], n_rows)
+    table['Period'] = MaskedColumn(RNG.uniform(0.1, 100, n_rows), mask=RNG.uniform(size=n_rows) < 0.3, unit='d')
+    table['separation'] = RNG.uniform(0, 10, n_rows) * units.arcsec
+    table['__redshift'] = MaskedColumn(RNG.uniform(0.001, 0.3, n_rows), mask=RNG.uniform(size=n_rows) < 0.3)
+    table['Distance_distance'] = RNG.uniform(1, 1000, n_rows)
+    table['Distance_unit'] = RNG.choice(['pc', 'kpc', 'Mpc', ''], n_rows)
+    return table
+
+
+def rows_str(table):
+    return [to_str(row['Name']) for row in table], [to_str(row['Type']) for row in table]
+
+
+def columns_str(table):
+    return to_str_column(table['Name']), to_str_column(table['Type'])
+
+
+def rows_redshift_distance(table):
+    return [None if np.ma.is_masked(z) else COSMO.luminosity_distance(z) for z in table['__redshift']]
+
+
+def columns_redshift_distance(table):
+    # Catalogs with redshift use the default method of _CatalogQuery
+    ASTROCATS_QUERY.add_distance_column(table)
+    return table['__distance']
+
+
+def rows_unit_distance(table):
+    return table['Distance_distance'] * [units.Unit(u) for u in table['Distance_unit']]
+
+
+def columns_unit_distance(table):
+    SIMBAD_QUERY.add_distance_column(table)
+    return table['__distance']
+
+
+HTML_COLUMNS = ['Name', 'separation', 'Type', 'Period']
+
+
+def rows_html(table, columns=HTML_COLUMNS):
+    table = table[columns].copy()
+    for column in table.colnames:
+        table[column] = [to_str(x) for x in table[column]]
+    return table
+
+
+def columns_html(table, columns=HTML_COLUMNS):
+    table = table[columns].copy()
+    for column in table.colnames:
+        table[column] = to_str_column(table[column])
+    return table
+
+
+CASES = {
+    'name and type strings': (rows_str, columns_str),
+    'redshift to distance': (rows_redshift_distance, columns_redshift_distance),
+    'distance with units': (rows_unit_distance, columns_unit_distance),
+    'html cells': (rows_html, columns_html),
+}
+
+
+def ms(f, *args):
+    n, t = timeit.Timer(lambda: f(*args)).autorange()
+    return t / n * 1e3
+
+
+def main():
+    z = np.geomspace(1e-4, 5, 10_000)
+    error = np.max(np.abs(LUMINOSITY_DISTANCE(z) / COSMO.luminosity_distance(z).to_value(units.Mpc) - 1))
+    print(f'Maximum relative error of interpolated luminosity distance: {error:.1e}')
+    for n_rows in (10, 100, 1000):
+        table = vizier_table(n_rows)
+        print(f'\n{n_rows} rows')
+        print(f'{"derivation":>25} {"rows, ms":>10} {"columns, ms":>12} {"speed-up":>9}')
+        for name, (rows, columns) in CASES.items():
+            rows_ms = ms(rows, table)
+            columns_ms = ms(columns, table)
+            print(f'{name:>25} {rows_ms:10.3f} {columns_ms:12.3f} {rows_ms / columns_ms:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Per-observation cost of plot data preparation: lists of observation dicts vs LightCurve columns
+
+The former is how get_plot_data and get_folded_plot_data worked before LightCurve: a Time object and strftime()
+per observation and folding observation by observation.
+
+Run from the repository root:
+    CACHE_TYPE=memory python3 benchmarks/plot_data.py
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import MJD_OFFSET, plot_data_frame  # noqa: E402
+from lightcurve import LightCurve  # noqa: E402
+from util import mjd_to_datetime  # noqa: E402
+
+
+RNG = np.random.default_rng(0)
+PERIOD = 0.37
+
+
+def records(n_obs):
+    mjd = np.sort(RNG.uniform(58194, 58664, n_obs))
+    return [dict(mjd=float(t), mag=float(RNG.normal(15, 0.3)), magerr=float(RNG.uniform(0.01, 0.05)),
+                 clrcoeff=float(RNG.normal(0.1, 0.01)))
+            for t in mjd]
+
+
+def light_curves(n_obs, n_neighbours):
+    return {680113300005170 + i: records(n_obs) for i in range(n_neighbours + 1)}
+
+
+def dicts_plot_data(lcs):
+    result = {}
+    for oid, lc in lcs.items():
+        lc = [dict(obs) for obs in lc]
+        for obs in lc:
+            obs['oid'] = oid
+            obs['filter'] = 'zr'
+            obs[f'mjd_{MJD_OFFSET}'] = obs['mjd'] - MJD_OFFSET
+            obs['Heliodate'] = mjd_to_datetime(obs['mjd']).strftime('%Y-%m-%d %H:%M:%S')
+        result[oid] = lc
+    return result
+
+
+def dicts_folded(lcs):
+    for lc in lcs.values():
+        for obs in lc:
+            obs['folded_time'] = (obs['mjd'] - MJD_OFFSET) % PERIOD
+            obs['phase'] = obs['folded_time'] / PERIOD
+    return lcs
+
+
+def columns_plot_data(lcs):
+    return plot_data_frame({oid: lc.with_meta(oid=oid) for oid, lc in lcs.items()})
+
+
+def columns_folded(lcs):
+    folded = {}
+    for oid, lc in lcs.items():
+        folded_time = (lc['mjd'] - MJD_OFFSET) % PERIOD
+        folded[oid] = lc.with_columns(folded_time=folded_time, phase=folded_time / PERIOD)
+    return folded
+
+
+def us_per_obs(f, arg, n_obs):
+    n, t = timeit.Timer(lambda: f(arg)).autorange()
+    return t / n / n_obs * 1e6
+
+
+def main():
+    print(f'{"light curves":>22} {"stage":>10} {"dicts, us/obs":>14} {"columns, us/obs":>16} {"speed-up":>9}')
+    for n_obs, n_neighbours in ((200, 0), (2000, 0), (2000, 5)):
+        dicts = light_curves(n_obs, n_neighbours)
+        columns = {oid: LightCurve.from_records(lc, meta=dict(filter='zr')) for oid, lc in dicts.items()}
+        total_obs = n_obs * (n_neighbours + 1)
+        name = f'{n_obs} obs, {n_neighbours} neighbours'
+        stages = {
+            'plot data': (dicts_plot_data, dicts, columns_plot_data, columns),
+            'folding': (dicts_folded, dicts_plot_data(dicts), columns_folded, columns),
+        }
+        for stage, (dicts_f, dicts_arg, columns_f, columns_arg) in stages.items():
+            before = us_per_obs(dicts_f, dicts_arg, total_obs)
+            after = us_per_obs(columns_f, columns_arg, total_obs)
+            print(f'{name:>22} {stage:>10} {before:14.3f} {after:16.3f} {before / after:9.1f}')
+
+
+if __name__ == '__main__':
+    main()
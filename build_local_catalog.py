@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Convert a full catalog dump to the local catalog format, see local_catalog.py
+
+The input is any table file readable by astropy, e.g. FITS or VOTable downloaded from Vizier, with the same column
+names as the upstream service gives
+"""
+
+import importer
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from cross import get_catalog_query
+from local_catalog import catalog_paths
+
+
+def build(query, table, directory):
+    coord = SkyCoord(table[query._table_ra], table[query._table_dec], unit=[query._ra_unit, 'deg'], frame='icrs')
+    for name in table.colnames:
+        # Object columns cannot be memory-mapped
+        if table[name].dtype.kind == 'O':
+            table[name] = table[name].astype(str)
+    paths = catalog_paths(directory, query.normalized_query_name)
+    os.makedirs(directory, exist_ok=True)
+    if table.has_masked_values:
+        mask = np.zeros(len(table), dtype=[(name, bool) for name in table.colnames])
+        for name in table.colnames:
+            mask[name] = np.ma.getmaskarray(table[name])
+        np.save(paths['mask'], mask)
+    elif os.path.exists(paths['mask']):
+        os.remove(paths['mask'])
+    np.save(paths['rows'], table.filled().as_array())
+    np.save(paths['coord'], np.stack([coord.ra.to_value('deg'), coord.dec.to_value('deg')], axis=-1))
+    units = {name: col.unit.to_string() for name, col in table.columns.items() if col.unit is not None}
+    with open(paths['meta'], 'w') as fh:
+        json.dump(dict(units=units), fh)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('catalog', help='catalog name, e.g. gcvs, vsx, atlas, ztf-periodic or ogle')
+    parser.add_argument('input', help='table file with the whole catalog')
+    parser.add_argument('-o', '--output', required=True, help='directory to use as LOCAL_CATALOGS_DIR')
+    parser.add_argument('--format', default=None, help='astropy table format of the input file')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    query = get_catalog_query(args.catalog)
+    if not query.is_static:
+        raise ValueError(f'{query.query_name} is not a static catalog')
+    table = Table.read(args.input, format=args.format)
+    build(query, table, args.output)
+    logging.info(f'{len(table)} objects of {query.query_name} are saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
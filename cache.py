@@ -1,43 +1,973 @@
+import contextvars
 import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Optional
 
-from config import CACHE_TYPE
+import numpy as np
+from astropy.table import Table, Column, MaskedColumn
+
+import metrics
+from config import CACHE_TYPE, CACHE_L1_MAXBYTES, CACHE_L1_TTL
+from upstream import remaining_time
+from util import NotFound, CatalogUnavailable, DeadlineExceeded, ForkSafeExecutor
 
 
 TTL = 7 * 86400
-MAXSIZE = 1 << 16
+
+KEY_PREFIX = 'ztf-viewer'
+INVALIDATION_CHANNEL = f'{KEY_PREFIX}:invalidate'
+
+# Time given to a single process to fill a key before the others stop waiting for it
+FILL_LOCK_TTL = 30
+FILL_POLL_MIN_DELAY = 0.02
+FILL_POLL_MAX_DELAY = 0.5
+
+REFRESH_WORKERS = 4
+REFRESH_FAILURE_BACKOFF = 60
+
+CACHE_REQUESTS = metrics.counter('ztf_viewer_cache_requests_total',
+                                 'Cache lookups by result: hit, stale, negative or miss')
+CACHE_ERRORS = metrics.counter('ztf_viewer_cache_errors_total', 'Exceptions raised by cache lookups and fills')
+CACHE_VALUE_BYTES = metrics.histogram('ztf_viewer_cache_value_bytes', 'Size of encoded cached values',
+                                      buckets=metrics.SIZE_BUCKETS)
+CACHE_SERIALIZATION_SECONDS = metrics.histogram('ztf_viewer_cache_serialization_seconds',
+                                                'Time of encoding and decoding of cached values')
+CACHE_FILL_SECONDS = metrics.histogram('ztf_viewer_cache_fill_seconds', 'Time of upstream calls filling cache misses')
+CACHE_LOCAL_BYTES = metrics.gauge('ztf_viewer_cache_local_bytes', 'Size of values in the per-process cache')
+
+
+def _normalize_key_part(obj):
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted((_normalize_key_part(x) for x in obj), key=repr))
+    if isinstance(obj, Mapping):
+        return tuple(sorted(((k, _normalize_key_part(v)) for k, v in obj.items()), key=repr))
+    if isinstance(obj, (tuple, list)):
+        return tuple(_normalize_key_part(x) for x in obj)
+    # Query objects are module-level singletons without meaningful repr, their type is the same in every process
+    if type(obj).__repr__ is object.__repr__:
+        return f'{type(obj).__module__}.{type(obj).__qualname__}'
+    return obj
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """How long and how much data of a kind is cached
+
+    ttl is the lifetime of a value, None means that it never expires. soft_ttl enables stale-while-revalidate mode:
+    values older than soft_ttl are returned immediately and refreshed in background. max_bytes is the byte budget
+    of the policy in the shared storage, when it is exceeded "lru" eviction deletes the least recently used values
+    and "fifo" eviction deletes the oldest ones. versioned_by is the name of the argument, typically the data
+    release, which is a part of the keyspace, so values of different versions never mix.
+
+    not_found_ttl and unavailable_ttl are lifetimes of cached NotFound and CatalogUnavailable exceptions,
+    None means that the exception is not cached
+    """
+    name: str
+    ttl: Optional[int]
+    max_bytes: int
+    eviction: str = 'lru'
+    soft_ttl: Optional[int] = None
+    versioned_by: Optional[str] = None
+    not_found_ttl: Optional[int] = 3600
+    unavailable_ttl: Optional[int] = 10
+
+    def negative_ttl(self, exception):
+        # Time budget is specific to the caller, the next one may have enough time
+        if isinstance(exception, DeadlineExceeded):
+            return None
+        if isinstance(exception, CatalogUnavailable):
+            return self.unavailable_ttl
+        if isinstance(exception, NotFound):
+            return self.not_found_ttl
+        return None
+
+
+POLICIES = {policy.name: policy for policy in (
+    CachePolicy('default', ttl=TTL, max_bytes=256 << 20),
+    # Light curves and metadata of a data release never change, but the API reports its failures as NotFound
+    CachePolicy('dr', ttl=None, max_bytes=4 << 30, versioned_by='dr', not_found_ttl=600),
+    # Listings of nights, a night may be reprocessed
+    CachePolicy('products', ttl=TTL, max_bytes=64 << 20),
+    # Most of small cones are empty
+    CachePolicy('catalog', ttl=TTL, max_bytes=1 << 30, soft_ttl=86400, not_found_ttl=86400),
+    # Catalogs updated daily, e.g. TNS
+    CachePolicy('volatile', ttl=86400, max_bytes=256 << 20, eviction='fifo', soft_ttl=3600),
+    # Indexes of whole external services, they are small and rarely updated
+    CachePolicy('index', ttl=30 * 86400, max_bytes=64 << 20, soft_ttl=86400),
+    # Figures and tables served for download, rendering a figure takes a second
+    CachePolicy('rendered', ttl=7 * 86400, max_bytes=512 << 20, versioned_by='dr'),
+    # Images of external catalogs, they are served to browsers by our own URLs
+    CachePolicy('thumbnail', ttl=30 * 86400, max_bytes=256 << 20, not_found_ttl=86400),
+)}
+
+
+def make_key(policy, prefix, arguments):
+    """Cache key which is the same for all processes, unlike hash() of strings"""
+    normalized = repr(_normalize_key_part(arguments))
+    digest = hashlib.sha1(normalized.encode()).hexdigest()
+    if policy.versioned_by is None:
+        return f'{KEY_PREFIX}:{policy.name}:{prefix}:{digest}'
+    version = arguments[policy.versioned_by]
+    return f'{KEY_PREFIX}:{policy.name}:{version}:{prefix}:{digest}'
+
+
+class _TableColumns:
+    """astropy Table pickled as bare numpy arrays and column attributes"""
+
+    def __init__(self, table):
+        self.table = table
+
+    @staticmethod
+    def accepts(obj):
+        return type(obj) is Table and all(type(col) in (Column, MaskedColumn) for col in obj.itercols())
+
+    def __reduce__(self):
+        columns = []
+        for col in self.table.itercols():
+            attrs = dict(name=col.info.name, unit=col.info.unit, description=col.info.description,
+                         format=col.info.format, meta=dict(col.info.meta))
+            if isinstance(col, MaskedColumn):
+                attrs['fill_value'] = col.fill_value
+                columns.append((col.data.data, np.ma.getmaskarray(col), attrs))
+            else:
+                columns.append((col.data, None, attrs))
+        return _table_from_columns, (dict(self.table.meta), columns)
+
+
+def _table_from_columns(meta, columns):
+    cols = []
+    for data, mask, attrs in columns:
+        if mask is None:
+            cols.append(Column(data, copy=False, **attrs))
+        else:
+            cols.append(MaskedColumn(data, mask=mask, copy=False, **attrs))
+    return Table(cols, meta=meta, copy=False)
+
+
+class PickleCodec:
+    tag = b'p'
+
+    @staticmethod
+    def accepts(value):
+        return True
+
+    @staticmethod
+    def encode(value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(data):
+        return pickle.loads(data)
+
+
+class TableCodec(PickleCodec):
+    tag = b't'
+
+    @staticmethod
+    def accepts(value):
+        return _TableColumns.accepts(value)
+
+    @staticmethod
+    def encode(value):
+        return pickle.dumps(_TableColumns(value), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class NoCompression:
+    tag = b'-'
+
+    @staticmethod
+    def compress(data):
+        return data
+
+    @staticmethod
+    def decompress(data):
+        return data
+
+
+class ZlibCompression:
+    tag = b'd'
+
+    @staticmethod
+    def compress(data):
+        return zlib.compress(data, 1)
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
+
+
+class ZstdCompression:
+    tag = b'z'
+    level = 3
+
+    def __init__(self):
+        import zstandard
+
+        self._zstandard = zstandard
+
+    # Compressor objects are not thread-safe, so they are created per call
+    def compress(self, data):
+        return self._zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return self._zstandard.ZstdDecompressor().decompress(data)
+
+
+def _default_compression():
+    try:
+        return ZstdCompression()
+    except ImportError:
+        logging.warning('zstandard is not installed, zlib is used to compress cached values')
+        return ZlibCompression()
+
+
+CODECS = [TableCodec, PickleCodec]
+COMPRESSION = _default_compression()
+COMPRESSION_MIN_BYTES = 1024
+
+_codecs_by_tag = {codec.tag: codec for codec in CODECS}
+_compressions_by_tag = {compression.tag: compression for compression in (NoCompression, ZlibCompression, COMPRESSION)}
+
+
+def encode(value, codecs=None, compression=None):
+    """Serialize value with the first codec which accepts it
+
+    The first byte of the result is the codec tag and the second byte is the compression tag
+    """
+    return _encode_sized(value, codecs, compression)[0]
+
+
+def _encode_sized(value, codecs=None, compression=None):
+    """Encoded value and the size of the uncompressed payload"""
+    if codecs is None:
+        codecs = CODECS
+    if compression is None:
+        compression = COMPRESSION
+    codec = next(codec for codec in codecs if codec.accepts(value))
+    data = codec.encode(value)
+    if len(data) < COMPRESSION_MIN_BYTES:
+        compression = NoCompression
+    return codec.tag + compression.tag + compression.compress(data), len(data)
+
+
+def decode(data):
+    return _decode_sized(data)[0]
+
+
+def _decode_sized(data):
+    codec = _codecs_by_tag[data[:1]]
+    compression = _compressions_by_tag[data[1:2]]
+    payload = compression.decompress(data[2:])
+    return codec.decode(payload), len(payload)
+
+
+CacheEntry = namedtuple('CacheEntry', ('value', 'created'))
+
+
+class NegativeResult(namedtuple('NegativeResult', ('exception', 'args', 'ttl'))):
+    """Exception raised by a cached function, it is raised again on every cache hit until ttl expires"""
+
+    @classmethod
+    def from_exception(cls, exception, ttl):
+        return cls(type(exception), exception.args, ttl)
+
+    def reraise(self):
+        raise self.exception(*self.args)
+
+
+class Uncached(namedtuple('Uncached', ('value',))):
+    """Wrap a return value of a cached function to give it to the caller without storing, e.g. partial results"""
+
+
+def _entry_ttl(value, policy):
+    if isinstance(value, NegativeResult):
+        return value.ttl
+    return policy.ttl
+
+# Creation time is stored in front of the encoded value
+_ENTRY_HEADER = struct.Struct('<d')
+
+
+def encode_entry(entry):
+    """Encoded entry and the size of its uncompressed payload, the estimate of the memory taken by the decoded value"""
+    data, size = _encode_sized(entry.value)
+    return _ENTRY_HEADER.pack(entry.created) + data, size
+
+
+def decode_entry(data):
+    """Decoded entry and the size of its uncompressed payload"""
+    (created,) = _ENTRY_HEADER.unpack_from(data)
+    value, size = _decode_sized(data[_ENTRY_HEADER.size:])
+    return CacheEntry(value, created), size
+
+
+class LocalLRU:
+    """Thread-safe in-process LRU cache bounded by the total size of stored values"""
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _pop(self, key):
+        _value, size, _expires = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key, count=True):
+        """count=False is for re-checks of a key, which is already counted as a miss"""
+        with self._lock:
+            try:
+                value, _size, expires = self._data[key]
+            except KeyError:
+                self.misses += count
+                raise
+            if expires < time.monotonic():
+                self._pop(key)
+                self.misses += count
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            self.hits += count
+            return value
+
+    def set(self, key, value, ttl=None, size=None):
+        if size is None:
+            size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        ttls = [t for t in (ttl, self.ttl) if t is not None]
+        expires = time.monotonic() + min(ttls) if ttls else float('inf')
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _key, (_value, evicted_size, _expires) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._data), bytes=self._bytes)
 
 
-def _create_redis_cache():
+# KEYS: value key, access zset, sizes hash, total bytes counter
+# ARGV: data, ttl (0 means no expiration), now, max bytes, invalidation channel, origin
+_SET_SCRIPT = """
+local old_size = redis.call('hget', KEYS[3], KEYS[1])
+if old_size then
+    redis.call('decrby', KEYS[4], old_size)
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('set', KEYS[1], ARGV[1])
+end
+local size = string.len(ARGV[1])
+redis.call('hset', KEYS[3], KEYS[1], size)
+redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+redis.call('publish', ARGV[5], ARGV[6] .. ' ' .. KEYS[1])
+local total = redis.call('incrby', KEYS[4], size)
+while total > tonumber(ARGV[4]) do
+    local oldest = redis.call('zpopmin', KEYS[2])
+    if #oldest == 0 then
+        break
+    end
+    local key = oldest[1]
+    local evicted_size = redis.call('hget', KEYS[3], key)
+    redis.call('hdel', KEYS[3], key)
+    redis.call('del', key)
+    redis.call('publish', ARGV[5], '- ' .. key)
+    if evicted_size then
+        total = redis.call('decrby', KEYS[4], evicted_size)
+    end
+end
+return total
+"""
+
+# KEYS: value key, access zset, sizes hash, total bytes counter
+# ARGV: invalidation channel, origin
+_DELETE_SCRIPT = """
+local size = redis.call('hget', KEYS[3], KEYS[1])
+if size then
+    redis.call('decrby', KEYS[4], size)
+    redis.call('hdel', KEYS[3], KEYS[1])
+end
+redis.call('zrem', KEYS[2], KEYS[1])
+redis.call('del', KEYS[1])
+redis.call('publish', ARGV[1], ARGV[2] .. ' ' .. KEYS[1])
+"""
+
+
+class RedisStore:
+    """Shared storage of serialized values
+
+    Sizes and access times of the keys are tracked per policy, when the policy byte budget is exceeded
+    the least recently used (or the oldest for "fifo" eviction) keys are deleted. Expired keys stay in the
+    bookkeeping until they are the first to be evicted
+    """
+
+    def __init__(self, redis_conn):
+        self.conn = redis_conn
+        self._set_script = self.conn.register_script(_SET_SCRIPT)
+        self._delete_script = self.conn.register_script(_DELETE_SCRIPT)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _policy_keys(policy):
+        prefix = f'{KEY_PREFIX}:policy:{policy.name}'
+        return [f'{prefix}:access', f'{prefix}:sizes', f'{prefix}:bytes']
+
+    def get(self, key, policy, count=True):
+        if policy.eviction == 'lru':
+            access_key, *_ = self._policy_keys(policy)
+            pipeline = self.conn.pipeline(transaction=False)
+            pipeline.get(key)
+            pipeline.zadd(access_key, {key: time.time()}, xx=True)
+            data, _ = pipeline.execute()
+        else:
+            data = self.conn.get(key)
+        if data is None:
+            self.misses += count
+            raise KeyError(key)
+        self.hits += count
+        return data
+
+    def get_many(self, keys, policy):
+        """Values of the keys, None for missed ones"""
+        pipeline = self.conn.pipeline(transaction=False)
+        pipeline.mget(keys)
+        if policy.eviction == 'lru':
+            access_key, *_ = self._policy_keys(policy)
+            now = time.time()
+            pipeline.zadd(access_key, {key: now for key in keys}, xx=True)
+        data, *_ = pipeline.execute()
+        hits = sum(d is not None for d in data)
+        self.hits += hits
+        self.misses += len(data) - hits
+        return data
+
+    def set(self, key, data, policy, origin, ttl=None):
+        if len(data) > policy.max_bytes:
+            logging.warning(f'Value of {len(data)} bytes is too large for cache policy {policy.name}, skip it')
+            return
+        self._set_script(
+            keys=[key] + self._policy_keys(policy),
+            args=[data, ttl or 0, time.time(), policy.max_bytes, INVALIDATION_CHANNEL, origin],
+        )
+
+    def delete(self, key, policy, origin):
+        self._delete_script(keys=[key] + self._policy_keys(policy), args=[INVALIDATION_CHANNEL, origin])
+
+    def stats(self):
+        policy_bytes = self.conn.mget([self._policy_keys(policy)[-1] for policy in POLICIES.values()])
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            policy_bytes={name: int(b or 0) for name, b in zip(POLICIES, policy_bytes)},
+        )
+
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LayeredCache:
+    """Per-process LRU of deserialized values in front of the shared Redis storage
+
+    Every write and deletion is published to the other processes via Redis pub/sub,
+    they drop the key from their local LRU
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self._origin = None
+        self._release_lock_script = self.remote.conn.register_script(_RELEASE_LOCK_SCRIPT)
+
+    def _ensure_listener(self):
+        # gunicorn forks workers, each of them needs its own subscription thread
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._listener_lock:
+            if self._listener_pid == pid:
+                return
+            self._origin = uuid.uuid4().hex
+            self.local.clear()
+            thread = threading.Thread(target=self._listen, name='cache-invalidation', daemon=True)
+            thread.start()
+            self._listener_pid = pid
+
+    def _listen(self):
+        from redis.exceptions import RedisError
+
+        while True:
+            try:
+                pubsub = self.remote.conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    origin, key = message['data'].decode().split(' ', maxsplit=1)
+                    if origin != self._origin:
+                        self.local.delete(key)
+            except RedisError as e:
+                # Invalidation messages could be lost while we were disconnected
+                logging.warning(f'Cache invalidation subscription failed: {e}')
+                self.local.clear()
+                time.sleep(1)
+
+    def get(self, key, policy, site=None, count=True):
+        self._ensure_listener()
+        try:
+            return self.local.get(key, count=count)
+        except KeyError:
+            pass
+        data = self.remote.get(key, policy, count=count)
+        with CACHE_SERIALIZATION_SECONDS.time(function=site, operation='decode'):
+            entry, size = decode_entry(data)
+        self.local.set(key, entry, ttl=_entry_ttl(entry.value, policy), size=size)
+        return entry
+
+    def get_many(self, keys, policy, site=None):
+        """Entries of the keys which are found in any tier, with a single request to Redis"""
+        self._ensure_listener()
+        entries = {}
+        remote_keys = []
+        for key in keys:
+            try:
+                entries[key] = self.local.get(key)
+            except KeyError:
+                remote_keys.append(key)
+        if not remote_keys:
+            return entries
+        for key, data in zip(remote_keys, self.remote.get_many(remote_keys, policy)):
+            if data is None:
+                continue
+            with CACHE_SERIALIZATION_SECONDS.time(function=site, operation='decode'):
+                entry, size = decode_entry(data)
+            self.local.set(key, entry, ttl=_entry_ttl(entry.value, policy), size=size)
+            entries[key] = entry
+        return entries
+
+    def set(self, key, value, policy, site=None):
+        self._ensure_listener()
+        entry = CacheEntry(value, time.time())
+        with CACHE_SERIALIZATION_SECONDS.time(function=site, operation='encode'):
+            data, size = encode_entry(entry)
+        CACHE_VALUE_BYTES.observe(len(data), function=site)
+        ttl = _entry_ttl(value, policy)
+        self.remote.set(key, data, policy, self._origin, ttl=ttl)
+        self.local.set(key, entry, ttl=ttl, size=size)
+
+    def delete(self, key, policy):
+        self._ensure_listener()
+        self.local.delete(key)
+        self.remote.delete(key, policy, self._origin)
+
+    def acquire(self, key, ttl):
+        """Try to take a fill lock for key, returns a token for release() or None if somebody else holds it"""
+        token = uuid.uuid4().hex
+        if self.remote.conn.set(f'{key}:lock', token, nx=True, ex=ttl):
+            return token
+        return None
+
+    def release(self, key, token):
+        self._release_lock_script(keys=[f'{key}:lock'], args=[token])
+
+    def stats(self):
+        return dict(l1=self.local.stats(), l2=self.remote.stats())
+
+
+class MemoryCache:
+    """Single-process cache, there is nothing to share values with"""
+
+    def __init__(self, local):
+        self.local = local
+
+    def get(self, key, policy, site=None, count=True):
+        return self.local.get(key, count=count)
+
+    def get_many(self, keys, policy, site=None):
+        entries = {}
+        for key in keys:
+            try:
+                entries[key] = self.local.get(key)
+            except KeyError:
+                pass
+        return entries
+
+    def set(self, key, value, policy, site=None):
+        self.local.set(key, CacheEntry(value, time.time()), ttl=_entry_ttl(value, policy))
+
+    def delete(self, key, policy):
+        self.local.delete(key)
+
+    @staticmethod
+    def acquire(key, ttl):
+        # Concurrent fills are already coalesced within the process
+        return True
+
+    @staticmethod
+    def release(key, token):
+        pass
+
+    def stats(self):
+        return dict(l1=self.local.stats())
+
+
+def _create_redis_backend():
     from redis import StrictRedis
-    from redis_lru import RedisLRU
 
     from config import REDIS_HOSTNAME
 
     redis_conn = StrictRedis(REDIS_HOSTNAME)
-    redis_lru = RedisLRU(redis_conn, default_ttl=TTL, max_size=MAXSIZE)
-    cache = functools.partial(redis_lru, ttl=TTL)
-    return cache
-
+    local = LocalLRU(CACHE_L1_MAXBYTES, ttl=CACHE_L1_TTL)
+    return LayeredCache(local, RedisStore(redis_conn))
 
-def _crate_memory_cache():
-    from cachetools import cached, TTLCache
 
-    ttl_cache = TTLCache(MAXSIZE, ttl=TTL)
-    cache = functools.partial(cached, cache=ttl_cache)
-    return cache
+def _create_memory_backend():
+    return MemoryCache(LocalLRU(CACHE_L1_MAXBYTES))
 
 
-CACHE_CREATORS = {
-    'redis': _create_redis_cache,
-    'memory': _crate_memory_cache,
+BACKEND_CREATORS = {
+    'redis': _create_redis_backend,
+    'memory': _create_memory_backend,
 }
 
 
-def _get_cache():
+def _get_backend():
     try:
-        return CACHE_CREATORS[CACHE_TYPE.lower().strip()]()
+        return BACKEND_CREATORS[CACHE_TYPE.lower().strip()]()
     except KeyError as e:
-        raise ValueError(f'CACHE_TYPE must be one of: {", ".join(CACHE_CREATORS)}') from e
+        raise ValueError(f'CACHE_TYPE must be one of: {", ".join(BACKEND_CREATORS)}') from e
+
+
+_backend = _get_backend()
+CACHE_LOCAL_BYTES.set_function(lambda: _backend.local.stats()['bytes'])
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key within the process
+
+    The first caller runs the function, the others wait for its result or exception until the deadline of their own
+    request
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def run(self, key, f):
+        with self._lock:
+            future = self._futures.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._futures[key] = Future()
+        if not is_leader:
+            try:
+                return future.result(timeout=remaining_time())
+            except FutureTimeoutError:
+                raise DeadlineExceeded(f'Cache key {key} is not filled by another thread before the deadline') from None
+        try:
+            value = f()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+
+_single_flight = SingleFlight()
+
+
+def _store(key, value, policy, site):
+    if not isinstance(value, Uncached):
+        _backend.set(key, value, policy, site=site)
+
+
+def _fill_locked(key, fill, policy, site):
+    """Fill the key holding a shared lock, so only one process calls upstream at a time
+
+    Processes which didn't get the lock poll the cache until the value appears, the lock is released or expired
+    """
+    wait_until = time.monotonic() + FILL_LOCK_TTL
+    # The caller gives up at the deadline of its request, waiting for another process longer is pointless
+    remaining = remaining_time()
+    request_deadline = None if remaining is None else time.monotonic() + remaining
+    delay = FILL_POLL_MIN_DELAY
+    while time.monotonic() < wait_until:
+        token = _backend.acquire(key, FILL_LOCK_TTL)
+        if token is not None:
+            try:
+                # The caller has counted the miss already, the re-checks are not counted again
+                try:
+                    return _backend.get(key, policy, site=site, count=False).value
+                except KeyError:
+                    pass
+                value = fill()
+                _store(key, value, policy, site)
+                return value
+            finally:
+                _backend.release(key, token)
+        if request_deadline is not None and time.monotonic() + delay >= request_deadline:
+            raise DeadlineExceeded(f'Cache key {key} is not filled by another process before the deadline')
+        time.sleep(delay)
+        delay = min(2 * delay, FILL_POLL_MAX_DELAY)
+        try:
+            return _backend.get(key, policy, site=site, count=False).value
+        except KeyError:
+            pass
+    logging.warning(f'Cache key {key} is not filled by another process in {FILL_LOCK_TTL}s, filling it anyway')
+    value = fill()
+    _store(key, value, policy, site)
+    return value
+
+
+class BackgroundRefresher:
+    """Refreshes stale cache entries in background threads, at most one refresh per key at a time
+
+    A key is not refreshed again for REFRESH_FAILURE_BACKOFF seconds after a failure, so a service which is down is
+    not called on every page view
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ForkSafeExecutor(max_workers, thread_name_prefix='cache-refresh')
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._failed = {}
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._failed = {}
+
+    def schedule(self, key, fill, policy, site):
+        with self._lock:
+            if key in self._keys:
+                return
+            failed = self._failed.get(key)
+            if failed is not None and time.monotonic() - failed < REFRESH_FAILURE_BACKOFF:
+                return
+            self._keys.add(key)
+        # The refresh outlives the request, so it runs in an empty context without the deadline of the request
+        self._executor.submit(contextvars.Context().run, self._refresh, key, fill, policy, site)
+
+    def _refresh(self, key, fill, policy, site):
+        failed = None
+        try:
+            token = _backend.acquire(key, FILL_LOCK_TTL)
+            # Another process is refreshing the same key
+            if token is None:
+                return
+            try:
+                _store(key, fill(), policy, site)
+            finally:
+                _backend.release(key, token)
+        except Exception as e:
+            failed = time.monotonic()
+            CACHE_ERRORS.inc(function=site, exception=type(e).__name__)
+            logging.warning(f'Background refresh of cache key {key} failed, keep the stale value: {e!r}')
+        finally:
+            with self._lock:
+                self._keys.discard(key)
+                if failed is None:
+                    self._failed.pop(key, None)
+                else:
+                    self._failed = {k: t for k, t in self._failed.items()
+                                    if failed - t < REFRESH_FAILURE_BACKOFF}
+                    self._failed[key] = failed
+
+
+_refresher = BackgroundRefresher(REFRESH_WORKERS)
+
+
+def cache(policy='default', version=None, normalize=None):
+    """Cache function results according to the policy, see CachePolicy and POLICIES
+
+    version is a part of the keys, change it when the format of returned values changes. normalize is
+    {argument name: function} applied to the arguments before they are put into the key, e.g. dict(oid=int) makes
+    calls with 680113300005170 and '680113300005170' share the same value
+    """
+    if isinstance(policy, str):
+        policy = POLICIES[policy]
+
+    def decorator(f):
+        name = f'{f.__module__}.{f.__qualname__}'
+        prefix = name if version is None else f'{name}:v{version}'
+        signature = inspect.signature(f)
+        is_method = next(iter(signature.parameters), None) == 'self'
+
+        def get_key(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            if normalize is not None:
+                arguments = {name: normalize[name](value) if name in normalize else value
+                             for name, value in arguments.items()}
+            return make_key(policy, prefix, arguments)
+
+        def get_site(args):
+            """Call site name for metrics, methods are reported for each subclass separately"""
+            if is_method and args:
+                cls = type(args[0])
+                return f'{cls.__module__}.{cls.__qualname__}.{f.__name__}'
+            return name
+
+        def fill(site, args, kwargs):
+            with CACHE_FILL_SECONDS.time(function=site):
+                return f(*args, **kwargs)
+
+        def fill_or_negative(site, args, kwargs):
+            try:
+                return fill(site, args, kwargs)
+            except Exception as e:
+                ttl = policy.negative_ttl(e)
+                if ttl is None:
+                    raise
+                CACHE_ERRORS.inc(function=site, exception=type(e).__name__)
+                return NegativeResult.from_exception(e, ttl)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            key = get_key(args, kwargs)
+            site = get_site(args)
+            try:
+                entry = _backend.get(key, policy, site=site)
+            except KeyError:
+                pass
+            except Exception as e:
+                CACHE_ERRORS.inc(function=site, exception=type(e).__name__)
+                raise
+            else:
+                if isinstance(entry.value, NegativeResult):
+                    CACHE_REQUESTS.inc(function=site, result='negative')
+                    entry.value.reraise()
+                if policy.soft_ttl is not None and time.time() - entry.created > policy.soft_ttl:
+                    CACHE_REQUESTS.inc(function=site, result='stale')
+                    # Failed refresh keeps the stale value, so exceptions are not turned into negative results
+                    _refresher.schedule(key, lambda: fill(site, args, kwargs), policy, site)
+                else:
+                    CACHE_REQUESTS.inc(function=site, result='hit')
+                return entry.value
+            CACHE_REQUESTS.inc(function=site, result='miss')
+            try:
+                value = _single_flight.run(
+                    key,
+                    lambda: _fill_locked(key, lambda: fill_or_negative(site, args, kwargs), policy, site),
+                )
+            except Exception as e:
+                CACHE_ERRORS.inc(function=site, exception=type(e).__name__)
+                raise
+            if isinstance(value, NegativeResult):
+                value.reraise()
+            if isinstance(value, Uncached):
+                return value.value
+            return value
+
+        def invalidate(*args, **kwargs):
+            _backend.delete(get_key(args, kwargs), policy)
+
+        def get_many(calls):
+            """Look up many calls at once, calls are (args, kwargs) pairs
+
+            Returns {call index: value} of found values, cached exceptions are returned as NegativeResult
+            """
+            keys = [get_key(args, kwargs) for args, kwargs in calls]
+            if not keys:
+                return {}
+            site = get_site(calls[0][0])
+            entries = _backend.get_many(keys, policy, site=site)
+            values = {}
+            for i, key in enumerate(keys):
+                if key not in entries:
+                    CACHE_REQUESTS.inc(function=site, result='miss')
+                    continue
+                value = entries[key].value
+                CACHE_REQUESTS.inc(function=site, result='negative' if isinstance(value, NegativeResult) else 'hit')
+                values[i] = value
+            return values
+
+        def set_value(value, *args, **kwargs):
+            """Store the result of a call obtained elsewhere, an exception is stored as a negative result"""
+            if isinstance(value, Exception):
+                ttl = policy.negative_ttl(value)
+                if ttl is None:
+                    return
+                value = NegativeResult.from_exception(value, ttl)
+            _backend.set(get_key(args, kwargs), value, policy, site=get_site(args))
+
+        wrapper.cache_invalidate = invalidate
+        wrapper.cache_get_many = get_many
+        wrapper.cache_set = set_value
+        wrapper.cache_policy = policy
+        return wrapper
+
+    return decorator
+
+
+class ContentStore:
+    """Immutable binary blobs addressed by their SHA-256 digest"""
+
+    def __init__(self, policy):
+        if isinstance(policy, str):
+            policy = POLICIES[policy]
+        self.policy = policy
+        self._site = f'{__name__}.{type(self).__qualname__}.{policy.name}'
+
+    def _key(self, digest):
+        return f'{KEY_PREFIX}:{self.policy.name}:content:{digest}'
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        _backend.set(self._key(digest), data, self.policy, site=self._site)
+        return digest
+
+    def get(self, digest):
+        """Blob by its digest, raises KeyError if it is not stored or already evicted"""
+        return _backend.get(self._key(digest), self.policy, site=self._site).value
 
 
-cache = _get_cache()
+def cache_stats():
+    stats = _backend.stats()
+    for tier in stats.values():
+        requests = tier['hits'] + tier['misses']
+        tier['hit_rate'] = tier['hits'] / requests if requests else None
+    return stats
@@ -3,8 +3,14 @@ import os
 
 CACHE_TYPE = os.environ.get('CACHE_TYPE', 'redis')
 REDIS_HOSTNAME = os.environ.get('REDIS_URL', 'redis')
+CACHE_L1_MAXBYTES = int(os.environ.get('CACHE_L1_MAXBYTES', 128 << 20))
+CACHE_L1_TTL = int(os.environ.get('CACHE_L1_TTL', 600))
 LC_API_URL = os.environ.get('LC_API_URL', 'http://db.ztf.snad.space')
 PRODUCTS_URL = os.environ.get('PRODUCTS_URL', 'http://ztf-web-viewer-proxy')
 TNS_API_URL = os.environ.get('TNS_API_URL', 'https://wis-tns.weizmann.ac.il')
+LOCAL_CATALOGS_DIR = os.environ.get('LOCAL_CATALOGS_DIR', None)
+UPSTREAM_DEADLINE = float(os.environ.get('UPSTREAM_DEADLINE', 25))
+RENDER_SLOTS = int(os.environ.get('RENDER_SLOTS', 2))
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 20))
 
 TNS_API_KEY = os.environ.get('TNS_API_KEY', None)
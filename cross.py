@@ -1,33 +1,75 @@
+import copy
 import json
 import logging
 import urllib.parse
-from base64 import b64encode
 from collections import namedtuple
-from functools import partial
+from concurrent.futures import CancelledError
 from io import BytesIO
 from urllib.parse import urljoin, urlsplit, urlunsplit, urlencode
 
 import astropy.io.ascii
 import numpy as np
 import pandas as pd
-import requests
 from astropy import units
 from astropy.coordinates import SkyCoord
 from astropy.cosmology import FlatLambdaCDM
-from astropy.table import Table
-from astroquery.cds import cds
+from astropy.table import Table, MaskedColumn
 from astroquery.simbad import Simbad
 from astroquery.vizier import Vizier
 from astroquery.utils.commons import TableList
 
-from cache import cache
+from cache import cache, Uncached, ContentStore, NegativeResult
 from config import LC_API_URL, TNS_API_URL, TNS_API_KEY
-from util import to_str, anchor_form, INF, NotFound, CatalogUnavailable
+from lightcurve import LightCurve
+from local_catalog import get_local_catalog
+from upstream import service, POLICIES as UPSTREAM_POLICIES
+from util import (to_str_column, to_float_array, anchor_form, NotFound, CatalogUnavailable, angular_separation_arcsec,
+                  covering_cone, ForkSafeExecutor)
 
 
 COSMO = FlatLambdaCDM(H0=70, Om0=0.3)
 
 
+class LuminosityDistance:
+    """Luminosity distance in Mpc interpolated over a log-log grid of redshifts
+
+    Interpolation error is less than 1e-6, redshifts outside of the grid are computed exactly
+    """
+
+    def __init__(self, cosmology, z_min=1e-5, z_max=20.0, n=2048):
+        self.cosmology = cosmology
+        self.z_min = z_min
+        self.z_max = z_max
+        self.log_z = np.linspace(np.log(z_min), np.log(z_max), n)
+        self.log_d = np.log(cosmology.luminosity_distance(np.exp(self.log_z)).to_value(units.Mpc))
+
+    def __call__(self, z):
+        z = np.asarray(z, dtype=float)
+        d = np.full_like(z, np.nan)
+        inside = (z >= self.z_min) & (z <= self.z_max)
+        d[inside] = np.exp(np.interp(np.log(z[inside]), self.log_z, self.log_d))
+        outside = np.isfinite(z) & ~inside
+        if np.any(outside):
+            d[outside] = self.cosmology.luminosity_distance(z[outside]).to_value(units.Mpc)
+        return d
+
+
+LUMINOSITY_DISTANCE = LuminosityDistance(COSMO)
+
+
+def distance_column(values, unit):
+    """Distances with unit, NaN are masked"""
+    values = np.asarray(values, dtype=float)
+    return MaskedColumn(values, mask=~np.isfinite(values), unit=unit)
+
+
+def with_timeout(query, timeout):
+    """Copy of the astroquery object with another TIMEOUT, the objects are shared by threads and cannot be changed"""
+    query = copy.copy(query)
+    query.TIMEOUT = timeout
+    return query
+
+
 class _CatalogQuery:
     __objects = {}
 
@@ -36,11 +78,20 @@ class _CatalogQuery:
     period_column = None
     redshift_column = None
     _name_column = None
-    _query_region = None
+    # astroquery object and additional arguments of its query_region()
+    _query = None
+    _query_region_kwargs = {}
     _table_ra = None
     _ra_unit = None
     _table_dec = None
     columns = None
+    default_radius_arcsec = 10
+    # Seconds the object page waits for the query
+    timeout = 10
+    # Static catalogs are searched locally if they are in LOCAL_CATALOGS_DIR
+    is_static = False
+    # External service which is queried, see upstream.py
+    service_name = 'vizier'
 
     def __new__(cls, query_name):
         name = cls._normalize_name(query_name)
@@ -52,6 +103,11 @@ class _CatalogQuery:
 
     def __init__(self, query_name):
         self.__query_name = query_name
+        self._service = service(self.service_name)
+
+    @property
+    def _upstream_timeout(self):
+        return UPSTREAM_POLICIES[self.service_name].read_timeout
 
     @classmethod
     def get_objects(self):
@@ -80,12 +136,46 @@ class _CatalogQuery:
             return self._name_column
         return self.id_column
 
-    @cache()
+    @property
+    def local_catalog(self):
+        if not self.is_static:
+            return None
+        return get_local_catalog(self.normalized_query_name)
+
     def find(self, ra, dec, radius_arcsec):
+        # Local search is faster than the cache
+        if self.local_catalog is not None:
+            return self._find(ra, dec, radius_arcsec)
+        cone = covering_cone(ra, dec, radius_arcsec)
+        if cone is None:
+            return self._find_cached(ra, dec, radius_arcsec)
+        table = self._find_cached(*cone)
+        return self._select_cone(table, ra, dec, radius_arcsec)
+
+    @cache('catalog', version=2)
+    def _find_cached(self, ra, dec, radius_arcsec):
+        return self._find(ra, dec, radius_arcsec)
+
+    @staticmethod
+    def _select_cone(table, ra, dec, radius_arcsec):
+        """Rows of the covering cone table which are inside the cone"""
+        sep = angular_separation_arcsec(ra, dec, np.asarray(table['__ra']), np.asarray(table['__dec']))
+        idx = np.flatnonzero(sep <= radius_arcsec)
+        if idx.size == 0:
+            raise NotFound
+        idx = idx[np.argsort(sep[idx], kind='stable')]
+        table = table[idx]
+        table['separation'] = sep[idx] * units.arcsec
+        return table
+
+    def _find(self, ra, dec, radius_arcsec):
         coord = SkyCoord(ra, dec, unit='deg', frame='icrs')
         radius = f'{radius_arcsec}s'
         logging.info(f'Querying ra={ra}, dec={dec}, r={radius_arcsec}')
-        table = self._query_region(coord, radius=radius)
+        if (local_catalog := self.local_catalog) is not None:
+            table = local_catalog.query_region(ra, dec, radius_arcsec)
+        else:
+            table = self._upstream_query_region(coord, radius=radius)
         if table is None:
             raise NotFound
         if isinstance(table, TableList):
@@ -94,16 +184,27 @@ class _CatalogQuery:
             table = table[0]
         if len(table) == 0:
             raise NotFound
-        catalog_coord = SkyCoord(
-            table[self._table_ra], table[self._table_dec],
-            unit=[self._ra_unit, 'deg'],
-            frame='icrs'
-        )
-        table['separation'] = coord.separation(catalog_coord).to('arcsec')
+        # Local catalogs have coordinates in degrees already
+        if '__ra' not in table.colnames:
+            catalog_coord = SkyCoord(
+                table[self._table_ra], table[self._table_dec],
+                unit=[self._ra_unit, 'deg'],
+                frame='icrs'
+            )
+            table['__ra'] = catalog_coord.ra.to_value('deg')
+            table['__dec'] = catalog_coord.dec.to_value('deg')
+        sep = angular_separation_arcsec(ra, dec, np.asarray(table['__ra']), np.asarray(table['__dec']))
+        table['separation'] = sep * units.arcsec
         table.sort('separation')
         self.add_additional_columns(table)
         return table
 
+    def _upstream_query_region(self, coord, radius):
+        # astroquery timeouts are fixed, they are cut to the deadline of the request for every call
+        _connect_timeout, read_timeout = self._service.timeout()
+        query = with_timeout(self._query, read_timeout)
+        return self._service.call(query.query_region, coord, radius=radius, **self._query_region_kwargs)
+
     def add_additional_columns(self, table):
         self.add_objname_column(table)
         self.add_link_column(table)
@@ -113,14 +214,15 @@ class _CatalogQuery:
         self.add_distance_column(table)
 
     def add_objname_column(self, table):
-        table['__objname'] = [to_str(row[self.name_column]) for row in table]
+        table['__objname'] = to_str_column(table[self.name_column])
 
     def add_link_column(self, table):
-        table['__link'] = [self.get_link(row[self.id_column], row['__objname']) for row in table]
+        # Iterating over columns is much faster than over table rows
+        table['__link'] = [self.get_link(id, name) for id, name in zip(table[self.id_column], table['__objname'])]
 
     def add_type_column(self, table):
         if self.type_column is not None:
-            table['__type'] = [to_str(row[self.type_column]) for row in table]
+            table['__type'] = to_str_column(table[self.type_column])
 
     def add_period_column(self, table):
         if self.period_column is not None:
@@ -132,7 +234,7 @@ class _CatalogQuery:
 
     def add_distance_column(self, table):
         if '__redshift' in table.columns:
-            table['__distance'] = [None if z is None else COSMO.luminosity_distance(z) for z in table['__redshift']]
+            table['__distance'] = distance_column(LUMINOSITY_DISTANCE(to_float_array(table['__redshift'])), units.Mpc)
 
     def get_url(self, id):
         raise NotImplemented
@@ -146,6 +248,9 @@ catalog_query_objects = _CatalogQuery.get_objects
 
 class SimbadQuery(_CatalogQuery):
     id_column = 'MAIN_ID'
+    default_radius_arcsec = 50
+    timeout = 20
+    service_name = 'simbad'
     type_column = 'OTYPE'
     period_column = 'V__period'
     _table_ra = 'RA'
@@ -165,15 +270,23 @@ class SimbadQuery(_CatalogQuery):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._query = Simbad()
+        self._query.TIMEOUT = self._upstream_timeout
         self._query.add_votable_fields('distance', 'fluxdata(R)', 'fluxdata(V)', 'otype', 'otypes', 'v*')
-        self._query_region = self._query.query_region
 
     def get_url(self, id):
         qid = urllib.parse.quote(id)
         return f'//simbad.u-strasbg.fr/simbad/sim-id?Ident={qid}'
 
     def add_distance_column(self, table):
-        table['__distance'] = table['Distance_distance'] * [units.Unit(u) for u in table['Distance_unit']]
+        # Distances are given in a few units, every unit is parsed once
+        unit_names, inverse = np.unique(to_str_column(table['Distance_unit']), return_inverse=True)
+        factors = np.full(len(unit_names), np.nan)
+        for i, name in enumerate(unit_names):
+            try:
+                factors[i] = units.Unit(name).to(units.pc)
+            except ValueError:
+                continue
+        table['__distance'] = distance_column(to_float_array(table['Distance_distance']) * factors[inverse], units.pc)
 
 
 SIMBAD_QUERY = SimbadQuery('Simbad')
@@ -181,6 +294,7 @@ SIMBAD_QUERY = SimbadQuery('Simbad')
 
 class GCVSQuery(_CatalogQuery):
     id_column = 'GCVS'
+    is_static = True
     type_column = 'VarType'
     period_column = 'Period'
     _table_ra = 'RAJ2000'
@@ -197,10 +311,12 @@ class GCVSQuery(_CatalogQuery):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._query = Vizier(
+            row_limit=-1,
+            timeout=self._upstream_timeout,
             columns=['GCVS', 'RAJ2000', 'DEJ2000', 'VarType', 'magMax', 'Period', 'SpType', 'VarTypeII', 'VarName',
                      'Simbad'],
         )
-        self._query_region = partial(self._query.query_region, catalog='B/gcvs/gcvs_cat')
+        self._query_region_kwargs = dict(catalog='B/gcvs/gcvs_cat')
 
     def get_url(self, id):
         qid = urllib.parse.quote_plus(id)
@@ -212,6 +328,7 @@ GCVS_QUERY = GCVSQuery('GCVS')
 
 class VSXQuery(_CatalogQuery):
     id_column = 'OID'
+    is_static = True
     type_column = 'Type'
     period_column = 'Period'
     _table_ra = 'RAJ2000'
@@ -231,8 +348,8 @@ class VSXQuery(_CatalogQuery):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._query = Vizier()
-        self._query_region = partial(self._query.query_region, catalog='B/vsx/vsx')
+        self._query = Vizier(row_limit=-1, timeout=self._upstream_timeout)
+        self._query_region_kwargs = dict(catalog='B/vsx/vsx')
 
     def get_url(self, id):
         return f'//www.aavso.org/vsx/index.php?view=detail.top&oid={id}'
@@ -243,6 +360,7 @@ VSX_QUERY = VSXQuery('VSX')
 
 class AtlasQuery(_CatalogQuery):
     id_column = 'ATOID'
+    is_static = True
     type_column = 'Class'
     period_column = 'fp-LSper'
     _table_ra = 'RAJ2000'
@@ -258,9 +376,11 @@ class AtlasQuery(_CatalogQuery):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._query = Vizier(
+            row_limit=-1,
+            timeout=self._upstream_timeout,
             columns=['ATOID', 'RAJ2000', 'DEJ2000', 'fp-LSper', 'Class'],
         )
-        self._query_region = partial(self._query.query_region, catalog='J/AJ/156/241/table4')
+        self._query_region_kwargs = dict(catalog='J/AJ/156/241/table4')
 
     def get_url(self, id):
         return f'//vizier.u-strasbg.fr/viz-bin/VizieR-6?-out.form=%2bH&-source=J/AJ/156/241/table4&Source={id}'
@@ -277,6 +397,7 @@ class Gaia2Dis(_CatalogQuery):
     https://ui.adsabs.harvard.edu/abs/2018AJ....156...58B
     """
     id_column = 'Source'
+    default_radius_arcsec = 1
     _table_ra = 'RA_ICRS'
     _ra_unit = 'deg'
     _table_dec = 'DE_ICRS'
@@ -291,15 +412,17 @@ class Gaia2Dis(_CatalogQuery):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._query = Vizier(
+            row_limit=-1,
+            timeout=self._upstream_timeout,
             columns=['Source', 'RA_ICRS', 'DE_ICRS', 'rest', 'b_rest', 'B_rest', 'rlen', 'ResFlag', 'ModFlag'],
         )
-        self._query_region = partial(self._query.query_region, catalog='I/347/gaia2dis')
+        self._query_region_kwargs = dict(catalog='I/347/gaia2dis')
 
     def get_url(self, id):
         return f'//vizier.u-strasbg.fr/viz-bin/VizieR-6?-out.form=%2bH&-source=I/347/gaia2dis&Source={id}'
 
     def add_distance_column(self, table):
-        table['__distance'] = [x * units.pc for x in table['rest']]
+        table['__distance'] = distance_column(to_float_array(table['rest']), units.pc)
 
 
 GAIA2_DIS = Gaia2Dis('Gaia DR2 Distances')
@@ -310,10 +433,6 @@ class _ApiQuery(_CatalogQuery):
     def _base_api_url(self):
         raise NotImplemented
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._api_session = requests.Session()
-
     @staticmethod
     def _raise_if_not_ok(response):
         if response.status_code != 200:
@@ -323,6 +442,10 @@ class _ApiQuery(_CatalogQuery):
     def _api_query_region(self, ra, dec, radius_arcsec):
         raise NotImplemented
 
+    def _upstream_query_region(self, coord, radius):
+        # HTTP requests go through the service already
+        return self._query_region(coord, radius=radius)
+
     def _query_region(self, coord, radius):
         ra = coord.ra.to_value('deg')
         dec = coord.dec.to_value('deg')
@@ -338,6 +461,9 @@ class _ApiQuery(_CatalogQuery):
 
 class ZtfPeriodicQuery(_ApiQuery):
     id_column = 'SourceID'
+    is_static = True
+    default_radius_arcsec = 1
+    service_name = 'ztf-periodic'
     type_column = 'Type'
     period_column = 'Per'
     _name_column = 'ID'
@@ -358,7 +484,7 @@ class ZtfPeriodicQuery(_ApiQuery):
 
     def _api_query_region(self, ra, dec, radius_arcsec):
         query = {'ra': ra, 'dec': dec, 'radius_arcsec': radius_arcsec}
-        response = self._api_session.get(self._get_api_url(query))
+        response = self._service.get(self._get_api_url(query))
         self._raise_if_not_ok(response)
         j = response.json()
         table = Table.from_pandas(pd.DataFrame.from_records(j))
@@ -371,8 +497,14 @@ class ZtfPeriodicQuery(_ApiQuery):
 ZTF_PERIODIC_QUERY = ZtfPeriodicQuery('ZTF Periodic')
 
 
+class TnsRateLimited(CatalogUnavailable):
+    pass
+
+
 class TnsQuery(_ApiQuery):
     id_column = 'objname'
+    default_radius_arcsec = 5
+    service_name = 'tns'
     type_column = 'object_type'
     _name_column = 'fullname'
     _table_ra = 'radeg'
@@ -390,10 +522,22 @@ class TnsQuery(_ApiQuery):
         'internal_names': 'Internal names',
     }
 
+    # TNS limits the rate of bot requests, so only a few objects are requested at a time
+    object_workers = 4
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._search_api_url = urllib.parse.urljoin(TNS_API_URL, '/api/get/search')
         self._object_api_url = urllib.parse.urljoin(TNS_API_URL, '/api/get/object')
+        self._object_executor = ForkSafeExecutor(self.object_workers, thread_name_prefix='tns')
+
+    @cache('volatile', version=2)
+    def _find_cached(self, ra, dec, radius_arcsec):
+        table = self._find(ra, dec, radius_arcsec)
+        # Cone with some objects missed due to the rate limit is shown but not cached
+        if table.meta.get('partial'):
+            return Uncached(table)
+        return table
 
     @staticmethod
     def _prepare_request_data(data=None):
@@ -405,6 +549,9 @@ class TnsQuery(_ApiQuery):
         return prep
 
     def _reply(self, response):
+        if response.status_code == 429:
+            logging.warning(f'TNS rate limit is exceeded: {response.text}')
+            raise TnsRateLimited(response.text)
         self._raise_if_not_ok(response)
         j = response.json()
         if j['id_code'] != 200:
@@ -414,13 +561,14 @@ class TnsQuery(_ApiQuery):
 
     def _get_search(self, ra, dec, radius_arcsec):
         data = dict(ra=ra, dec=dec, radius=radius_arcsec, units='arcsec')
-        response = self._api_session.post(self._search_api_url, files=self._prepare_request_data(data))
+        response = self._service.post(self._search_api_url, files=self._prepare_request_data(data))
         reply = self._reply(response)
         return [obj['objname'] for obj in reply]
 
+    @cache('volatile')
     def _get_object(self, objname):
         data = dict(objname=objname, photometry=0, spectra=0)
-        response = self._api_session.post(self._object_api_url, files=self._prepare_request_data(data))
+        response = self._service.post(self._object_api_url, files=self._prepare_request_data(data))
 
         reply = self._reply(response)
         if not reply['public']:
@@ -437,18 +585,42 @@ class TnsQuery(_ApiQuery):
 
         return reply
 
+    def _get_objects(self, objnames):
+        """Get objects concurrently, returns them and whether some of them are skipped due to the rate limit"""
+        futures = [self._object_executor.submit(self._get_object, name) for name in objnames]
+        objs = []
+        rate_limited = None
+        for future in futures:
+            try:
+                obj = future.result()
+            except TnsRateLimited as e:
+                rate_limited = e
+                for f in futures:
+                    f.cancel()
+                continue
+            except CancelledError:
+                continue
+            if obj is not None:
+                objs.append(obj)
+        if rate_limited is not None and not objs:
+            raise rate_limited
+        return objs, rate_limited is not None
+
     def _api_query_region(self, ra, dec, radius_arcsec):
         objnames = self._get_search(ra, dec, radius_arcsec)
-        objs = [obj for name in objnames if (obj := self._get_object(name))]
+        objs, partial = self._get_objects(objnames)
         table = Table.from_pandas(pd.DataFrame.from_records(objs))
         table['fullname'] = [f'{row["name_prefix"] or ""}{row["objname"]}' for row in table]
+        table.meta['partial'] = partial
         return table
 
     def get_url(self, id):
         return f'//wis-tns.weizmann.ac.il/object/{id}'
 
     def add_redshift_column(self, table):
-        table['__redshift'] = [row['redshift'] if row['redshift'] else row['host_redshift'] for row in table]
+        redshift = to_float_array(table['redshift'])
+        host_redshift = to_float_array(table['host_redshift'])
+        table['__redshift'] = np.where(np.isfinite(redshift) & (redshift != 0), redshift, host_redshift)
 
 
 TNS_QUERY = TnsQuery('Transient Name Server')
@@ -456,6 +628,8 @@ TNS_QUERY = TnsQuery('Transient Name Server')
 
 class AstrocatsQuery(_ApiQuery):
     id_column = 'event'
+    default_radius_arcsec = 5
+    service_name = 'astrocats'
     type_column = 'claimedtype'
     redshift_column = 'redshift'
     _table_ra = 'ra'
@@ -481,7 +655,7 @@ class AstrocatsQuery(_ApiQuery):
 
     def _api_query_region(self, ra, dec, radius_arcsec):
         query = {'ra': ra, 'dec': dec, 'radius': radius_arcsec, 'format': 'csv', 'item': 0}
-        response = self._api_session.get(self._get_api_url(query))
+        response = self._service.get(self._get_api_url(query))
         self._raise_if_not_ok(response)
         table = astropy.io.ascii.read(BytesIO(response.content), format='csv', guess=False)
         table['references'] = [', '.join(f'<a href=//adsabs.harvard.edu/abs/{r}>{r}</a>'
@@ -503,6 +677,8 @@ ASTROCATS_QUERY = AstrocatsQuery('Astrocats')
 
 class OGLEQuery(_ApiQuery):
     id_column = 'ID'
+    is_static = True
+    service_name = 'ogle'
     type_column = 'Type'
     period_column = 'P_1'
     _table_ra = 'RA'
@@ -548,29 +724,60 @@ class OGLEQuery(_ApiQuery):
         'pagelen': '50',
     }
 
+    thumbnail_workers = 8
+    thumbnails = ContentStore('thumbnail')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._light_curve_session = requests.Session()
+        self._light_curve_service = service('ogledb')
+        self._thumbnail_executor = ForkSafeExecutor(self.thumbnail_workers, thread_name_prefix='ogle-thumbnail')
 
-    def _download_light_curve(self, id):
+    @cache('thumbnail')
+    def _thumbnail(self, id):
+        """Put light curve image to the content store, returns its digest and the original URL"""
         basepath = f'{id[-2:]}/{id}'
         paths = [basepath + '.png', basepath + '_1.png']
         light_curve_urls = [urllib.parse.urljoin(self._base_light_curve_url, path) for path in paths]
         for url in light_curve_urls:
-            response = self._light_curve_session.get(url)
+            response = self._light_curve_service.get(url)
             if response.status_code == 200:
-                data = b64encode(response.content).decode()
-                return f'<a href="{url}"><img src="data:image/png;base64,{data}" width=200px /></a>'
-        return ''
+                return dict(digest=self.thumbnails.put(response.content), url=url)
+        raise NotFound
+
+    def thumbnail(self, id):
+        """PNG light curve image and its digest"""
+        digest = self._thumbnail(id)['digest']
+        try:
+            return self.thumbnails.get(digest), digest
+        except KeyError:
+            # The image has been evicted earlier than the reference to it
+            self._thumbnail.cache_invalidate(self, id)
+            digest = self._thumbnail(id)['digest']
+            return self.thumbnails.get(digest), digest
+
+    def _light_curve_html(self, id):
+        try:
+            url = self._thumbnail(id)['url']
+        # A missing thumbnail doesn't fail the whole table
+        except (NotFound, CatalogUnavailable):
+            return ''
+        return f'<a href="{url}"><img src="/thumbnail/ogle/{urllib.parse.quote(id)}" width=200px /></a>'
 
     def _api_query_region(self, ra, dec, radius_arcsec):
         query = {'ra': ra, 'dec': dec, 'radius_arcsec': radius_arcsec, 'format': 'tsv'}
-        response = self._api_session.get(self._get_api_url(query))
+        response = self._service.get(self._get_api_url(query))
         self._raise_if_not_ok(response)
         table = astropy.io.ascii.read(BytesIO(response.content), format='tab', guess=False)
-        table['light_curve'] = [self._download_light_curve(row[self.id_column]) for row in table]
         return table
 
+    def add_additional_columns(self, table):
+        super().add_additional_columns(table)
+        self.add_light_curve_column(table)
+
+    def add_light_curve_column(self, table):
+        futures = [self._thumbnail_executor.submit(self._light_curve_html, row[self.id_column]) for row in table]
+        table['light_curve'] = [future.result() for future in futures]
+
     def get_link(self, id, name):
         return anchor_form(self._post_url, dict(**self._post_data, val_id=id), name)
 
@@ -586,24 +793,44 @@ def get_catalog_query(catalog):
 
 
 class VizierCatalogDetails:
-    @staticmethod
-    @cache()
-    def _query_cds(catalog_id):
+    """Descriptions of VizieR tables from the index of all of them
+
+    The index is requested from the CDS MOC server at once and refreshed daily in background, so the list of
+    Vizier catalogs needs no request per catalog
+    """
+
+    _mocserver_url = 'http://alasky.unistra.fr/MocServer/query'
+    _id_prefix = 'CDS/'
+
+    def __init__(self):
+        self._service = service('cds')
+
+    @cache('index')
+    def _descriptions(self):
+        response = self._service.get(
+            self._mocserver_url,
+            params=dict(ID=f'{self._id_prefix}*', get='record', fmt='json', fields='ID,obs_description'),
+        )
+        if response.status_code != 200:
+            logging.warning(f'{response.url} returned {response.status_code}')
+            raise CatalogUnavailable(response.text)
+        descriptions = {}
+        for record in response.json():
+            description = record.get('obs_description')
+            if not description:
+                continue
+            # Multi-valued properties are lists
+            if isinstance(description, list):
+                description = description[0]
+            descriptions[record['ID'][len(self._id_prefix):]] = description
+        logging.info(f'Index of {len(descriptions)} VizieR table descriptions is loaded')
+        return descriptions
+
+    def description(self, catalog_id):
         try:
-            table = cds.find_datasets(f'ID=*{catalog_id}*')
-        except np.ma.MaskError as e:
-            logging.error(str(e))
+            return self._descriptions()[catalog_id]
+        except KeyError as e:
             raise NotFound from e
-        if len(table) == 0:
-            raise NotFound
-        return table[0]
-
-    @staticmethod
-    def description(catalog_id):
-        result = VizierCatalogDetails._query_cds(catalog_id)
-        if result is None:
-            raise NotFound
-        return result['obs_description']
 
 
 vizier_catalog_details = VizierCatalogDetails()
@@ -619,15 +846,19 @@ class FindVizier:
     _table_sep = '_r'
 
     def __init__(self):
-        self._query = Vizier(columns=[self._table_ra, self._table_dec, self._table_sep])
+        self._service = service('vizier')
+        self._query = Vizier(columns=[self._table_ra, self._table_dec, self._table_sep],
+                             timeout=UPSTREAM_POLICIES['vizier'].read_timeout)
         self._query.ROW_LIMIT = self.row_limit
 
-    @cache()
+    @cache('catalog')
     def find(self, ra, dec, radius_arcsec):
         coord = SkyCoord(ra, dec, unit='deg', frame='icrs')
         radius = f'{radius_arcsec}s'
         logging.info(f'Querying Vizier ra={ra}, dec={dec}, r={radius_arcsec}')
-        table_list = self._query.query_region(coord, radius=radius)
+        _connect_timeout, read_timeout = self._service.timeout()
+        query = with_timeout(self._query, read_timeout)
+        table_list = self._service.call(query.query_region, coord, radius=radius)
         return table_list
 
     @staticmethod
@@ -646,7 +877,7 @@ class _BaseFindZTF:
     _base_api_url = urljoin(LC_API_URL, '/api/v3/')
 
     def __init__(self):
-        self._api_session = requests.Session()
+        self._service = service('lc-api')
 
     def _api_url(self, dr):
         return urljoin(self._base_api_url, f'data/{dr}/')
@@ -656,8 +887,13 @@ class _BaseFindZTF:
 
 
 class FindZTFOID(_BaseFindZTF):
+    # Number of OIDs in a single API request
+    batch_size = 64
+    batch_workers = 8
+
     def __init__(self):
         super().__init__()
+        self._batch_executor = ForkSafeExecutor(self.batch_workers, thread_name_prefix='ztf-oid')
 
     def _oid_api_url(self, dr):
         return urljoin(self._api_url(dr), 'oid/full/json')
@@ -671,14 +907,94 @@ class FindZTFOID(_BaseFindZTF):
     def _query_dict(oid):
         return dict(oid=oid)
 
-    @cache()
+    @staticmethod
+    def _parse_object(j):
+        """Replace light curve list with LightCurve sorted by MJD"""
+        meta = j['meta']
+        lc_meta = dict(filter=meta['filter'], fieldid=meta['fieldid'], rcid=meta['rcid'])
+        return dict(j, lc=LightCurve.from_records(j['lc'], meta=lc_meta))
+
+    @cache('dr', version=3, normalize=dict(oid=int))
     def find(self, oid, dr):
-        resp = self._api_session.get(self._oid_api_url(dr), params=self._query_dict(oid))
+        resp = self._service.get(self._oid_api_url(dr), params=self._query_dict(oid))
         if resp.status_code != 200:
             message = f'{resp.url} returned {resp.status_code}: {resp.text}'
             logging.info(message)
             raise NotFound(message)
-        return resp.json()[str(oid)]
+        return self._parse_object(resp.json()[str(oid)])
+
+    def _find_batch(self, oids, dr):
+        """Request many objects at once, returns {oid: object} and caches every object
+
+        None is returned if the API rejects the batch request, the objects should be requested one by one then
+        """
+        resp = self._service.get(self._oid_api_url(dr), params=self._query_dict(oids))
+        if 400 <= resp.status_code < 500:
+            logging.info(f'Batch request of {len(oids)} objects returned {resp.status_code}, request them one by one')
+            return None
+        if resp.status_code != 200:
+            raise CatalogUnavailable(f'{resp.url} returned {resp.status_code}: {resp.text}')
+        j = resp.json()
+        objs = {}
+        for oid in oids:
+            obj = j.get(str(oid))
+            if obj is None:
+                # The API omits unknown OIDs from the reply, they are cached as NotFound for not_found_ttl of the 'dr'
+                # policy (600 s), the same as a failed single request
+                self.find.cache_set(NotFound(f'{oid} is not found in {dr}'), self, oid, dr)
+                continue
+            obj = self._parse_object(obj)
+            self.find.cache_set(obj, self, oid, dr)
+            objs[oid] = obj
+        return objs
+
+    def _find_one_by_one(self, oids, dr):
+        futures = {oid: self._batch_executor.submit(self.find, oid, dr) for oid in oids}
+        objs = {}
+        for oid, future in futures.items():
+            try:
+                objs[oid] = future.result()
+            except NotFound:
+                pass
+        return objs
+
+    @staticmethod
+    def _results(futures):
+        """Results of the futures, the rest are cancelled on the first exception"""
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def find_many(self, oids, dr):
+        """Objects by their OIDs as {oid: object}, unknown OIDs are missed
+
+        Cache is checked with a single request and missed objects are requested in concurrent batches
+        """
+        oids = list(dict.fromkeys(oids))
+        cached = self.find.cache_get_many([((self, oid, dr), {}) for oid in oids])
+        objs = {}
+        missed = []
+        for i, oid in enumerate(oids):
+            if i not in cached:
+                missed.append(oid)
+            elif not isinstance(cached[i], NegativeResult):
+                objs[oid] = cached[i]
+        batches = [missed[i:i + self.batch_size] for i in range(0, len(missed), self.batch_size)]
+        # Single requests are submitted from here, not from the batch tasks, so they don't wait for a free thread
+        # occupied by their own batch
+        futures = [self._batch_executor.submit(self._find_batch, batch, dr) for batch in batches]
+        rejected = []
+        for batch, batch_objs in zip(batches, self._results(futures)):
+            if batch_objs is None:
+                rejected.extend(batch)
+            else:
+                objs.update(batch_objs)
+        if rejected:
+            objs.update(self._find_one_by_one(rejected, dr))
+        return objs
 
     def get_coord(self, oid, dr):
         meta = self.get_meta(oid, dr)
@@ -703,28 +1019,43 @@ class FindZTFOID(_BaseFindZTF):
         return j['meta']
 
     def get_lc(self, oid, dr, min_mjd=None, max_mjd=None):
-        if min_mjd is None:
-            min_mjd = -INF
-        if max_mjd is None:
-            max_mjd = INF
         j = self.find(oid, dr)
-        lc = [obs.copy() for obs in j['lc'] if min_mjd <= obs['mjd'] <= max_mjd]
-        return lc
+        return j['lc'].between(min_mjd, max_mjd)
 
 
 find_ztf_oid = FindZTFOID()
 
 
 class FindZTFCircle(_BaseFindZTF):
+    default_radius_arcsec = 1
+
     def __init__(self):
         super().__init__()
 
     def _circle_api_url(self, dr):
         return urljoin(self._api_url(dr), 'circle/full/json')
 
-    @cache()
     def find(self, ra, dec, radius_arcsec, dr):
-        resp = self._api_session.get(
+        radius_arcsec = float(radius_arcsec)
+        cone = covering_cone(ra, dec, radius_arcsec)
+        if cone is None:
+            return self._find_cached(ra, dec, radius_arcsec, dr)
+        j = self._find_cached(*cone, dr)
+        if not j:
+            return j
+        oids = list(j)
+        sep = angular_separation_arcsec(
+            ra,
+            dec,
+            np.array([j[oid]['meta']['coord']['ra'] for oid in oids]),
+            np.array([j[oid]['meta']['coord']['dec'] for oid in oids]),
+        )
+        # Cached objects are shared, so they are copied instead of being updated in place
+        return {oid: dict(j[oid], separation=r) for oid, r in zip(oids, sep) if r <= radius_arcsec}
+
+    @cache('dr')
+    def _find_cached(self, ra, dec, radius_arcsec, dr):
+        resp = self._service.get(
             self._circle_api_url(dr),
             params=dict(ra=ra, dec=dec, radius_arcsec=radius_arcsec),
         )
@@ -749,15 +1080,16 @@ class LightCurveFeatures:
     _base_api_url = 'http://features.lc.snad.space'
 
     def __init__(self):
-        self._api_session = requests.Session()
+        self._service = service('features')
         self._find_ztf_oid = find_ztf_oid
 
-    @cache()
+    @cache('dr', normalize=dict(oid=int))
     def __call__(self, oid, dr, min_mjd=None, max_mjd=None):
         lc = find_ztf_oid.get_lc(oid, dr, min_mjd=min_mjd, max_mjd=max_mjd)
-        light_curve = [dict(t=obs['mjd'], m=obs['mag'], err=obs['magerr']) for obs in lc]
+        light_curve = [dict(t=t, m=m, err=err) for t, m, err in zip(lc['mjd'].tolist(), lc['mag'].tolist(),
+                                                                    lc['magerr'].tolist())]
         j = dict(light_curve=light_curve)
-        resp = self._api_session.post(self._base_api_url, json=j)
+        resp = self._service.post(self._base_api_url, json=j)
         if resp.status_code != 200:
             raise NotFound
         return resp.json()
@@ -0,0 +1,78 @@
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+
+class LightCurve:
+    """Observations of a single object as numpy arrays, with scalar metadata like oid and filter
+
+    Columns are accessed by name, lc['mjd'], the arrays are shared between light curves derived from each other,
+    so they must not be modified in place. Observations are expected to be sorted by MJD, from_records sorts them
+    """
+
+    COLUMNS = ('mjd', 'mag', 'magerr', 'clrcoeff')
+
+    def __init__(self, columns, meta=None):
+        self.columns = {name: np.asarray(value) for name, value in columns.items()}
+        self.meta = {} if meta is None else dict(meta)
+
+    @classmethod
+    def from_records(cls, records, meta=None):
+        """Light curve from the list of observation dicts like the light curve API gives"""
+        records = list(records)
+        meta = {} if meta is None else meta
+        names = [name for name in dict.fromkeys(chain(cls.COLUMNS, *records)) if name not in meta]
+        columns = {}
+        for name in names:
+            dtype = float if name in cls.COLUMNS else None
+            columns[name] = np.array([obs.get(name, np.nan) for obs in records], dtype=dtype)
+        mjd = columns['mjd']
+        if np.any(mjd[1:] < mjd[:-1]):
+            order = np.argsort(mjd, kind='stable')
+            columns = {name: value[order] for name, value in columns.items()}
+        return cls(columns, meta)
+
+    def __len__(self):
+        return len(self.columns['mjd'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __repr__(self):
+        return f'LightCurve(n={len(self)}, columns={list(self.columns)}, meta={self.meta})'
+
+    def select(self, index):
+        return LightCurve({name: value[index] for name, value in self.columns.items()}, self.meta)
+
+    def between(self, min_mjd=None, max_mjd=None):
+        """Observations with min_mjd <= mjd <= max_mjd, columns of the result are views of the original arrays"""
+        mjd = self.columns['mjd']
+        start = 0 if min_mjd is None else np.searchsorted(mjd, min_mjd, side='left')
+        stop = len(self) if max_mjd is None else np.searchsorted(mjd, max_mjd, side='right')
+        if start == 0 and stop == len(self):
+            return self
+        return self.select(slice(start, stop))
+
+    def with_columns(self, **columns):
+        return LightCurve(dict(self.columns, **columns), self.meta)
+
+    def with_meta(self, **meta):
+        return LightCurve(self.columns, dict(self.meta, **meta))
+
+    def to_records(self, names=None):
+        """List of observation dicts with Python scalars, e.g. for JSON"""
+        if names is None:
+            names = list(self.columns)
+        values = [self.columns[name].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def to_dataframe(self, meta=True):
+        """Data frame of the observations, metadata values are repeated for every observation if meta is True"""
+        df = pd.DataFrame(self.columns)
+        if meta:
+            df = df.assign(**self.meta)
+        return df
@@ -0,0 +1,99 @@
+"""Cone search within static catalogs stored on the local disk
+
+A catalog is a set of files in LOCAL_CATALOGS_DIR named after the normalized catalog query name, see
+build_local_catalog.py:
+- NAME.npy: structured array of catalog rows in the same format as the upstream service gives them
+- NAME.coord.npy: (N, 2) array of ICRS right ascension and declination in degrees
+- NAME.mask.npy: optional structured boolean array of masked values
+- NAME.json: column units
+Row and coordinate arrays are memory-mapped, so all gunicorn workers share the same pages of the files. The KD-tree
+with its copy of object unit vectors is built in every worker on the first search in the catalog, it takes a few
+seconds and several tens of bytes per object for the largest catalogs like VSX
+"""
+
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+
+from config import LOCAL_CATALOGS_DIR
+
+
+def unit_vectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def catalog_paths(directory, name):
+    base = os.path.join(directory, name)
+    return dict(rows=f'{base}.npy', coord=f'{base}.coord.npy', mask=f'{base}.mask.npy', meta=f'{base}.json')
+
+
+class LocalCatalog:
+    """Memory-mapped catalog with KD-tree index built on unit vectors of its objects"""
+
+    def __init__(self, directory, name):
+        from scipy.spatial import cKDTree
+
+        paths = catalog_paths(directory, name)
+        self.name = name
+        self.rows = np.load(paths['rows'], mmap_mode='r')
+        self.coord = np.load(paths['coord'], mmap_mode='r')
+        try:
+            self.mask = np.load(paths['mask'], mmap_mode='r')
+        except FileNotFoundError:
+            self.mask = None
+        with open(paths['meta']) as fh:
+            self.units = json.load(fh)['units']
+        self.tree = cKDTree(unit_vectors(self.coord[:, 0], self.coord[:, 1]))
+        logging.info(f'Local catalog {name} of {len(self.rows)} objects is loaded')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def query_region(self, ra, dec, radius_arcsec):
+        """Table of objects inside the cone with additional __ra and __dec columns"""
+        # Euclidean distance between unit vectors is the chord length
+        chord = 2.0 * np.sin(0.5 * np.radians(radius_arcsec / 3600.0))
+        idx = np.sort(np.asarray(self.tree.query_ball_point(unit_vectors(ra, dec), chord), dtype=np.intp))
+        table = Table(np.asarray(self.rows[idx]))
+        table['__ra'] = self.coord[idx, 0]
+        table['__dec'] = self.coord[idx, 1]
+        if self.mask is not None:
+            mask = self.mask[idx]
+            for name in mask.dtype.names:
+                if np.any(mask[name]):
+                    table[name] = MaskedColumn(table[name], mask=mask[name])
+        for name, unit in self.units.items():
+            table[name].unit = unit
+        return table
+
+
+_catalogs = {}
+_catalog_locks = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_local_catalog(name):
+    """Local catalog or None if it is not available"""
+    if LOCAL_CATALOGS_DIR is None:
+        return None
+    try:
+        return _catalogs[name]
+    except KeyError:
+        pass
+    # Loading takes seconds, a lock per catalog keeps searches in the other catalogs going
+    with _catalogs_lock:
+        lock = _catalog_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _catalogs:
+            try:
+                _catalogs[name] = LocalCatalog(LOCAL_CATALOGS_DIR, name)
+            except FileNotFoundError:
+                _catalogs[name] = None
+        return _catalogs[name]
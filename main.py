@@ -13,9 +13,14 @@ from astropy.coordinates.name_resolve import get_icrs_coordinates, NameResolveEr
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
+from flask import g, jsonify, Response
 
 from app import app
+from cache import cache_stats
+from config import UPSTREAM_DEADLINE
+from metrics import registry as metrics_registry
 from search import get_layout as get_search_layout
+from upstream import set_deadline, reset_deadline
 from util import available_drs, default_dr, joiner, YEAR
 from viewer import get_layout as get_viewer_layout
 
@@ -268,6 +273,29 @@ def app_select_by_url(pathname):
     return html.H1('404')
 
 
+@app.server.before_request
+def set_upstream_deadline():
+    # Upstream calls of the request should fail before gunicorn kills the worker
+    g.upstream_deadline = set_deadline(UPSTREAM_DEADLINE)
+
+
+@app.server.teardown_request
+def reset_upstream_deadline(exception=None):
+    token = g.pop('upstream_deadline', None)
+    if token is not None:
+        reset_deadline(token)
+
+
+@app.server.route('/cache/stats')
+def response_cache_stats():
+    return jsonify(cache_stats())
+
+
+@app.server.route('/metrics')
+def response_metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 def server():
     """Entrypoint for Gunicorn"""
     return app.server
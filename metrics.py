@@ -0,0 +1,267 @@
+"""Prometheus-format metrics
+
+Every process accumulates increments locally and periodically flushes them to Redis, so /metrics of any gunicorn
+worker shows counters and histograms summed over all workers. Gauges are per-process values, they are stored
+with a "worker" label and expire when the worker is gone
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from config import CACHE_TYPE
+
+
+METRICS_PREFIX = 'ztf-viewer:metrics'
+FLUSH_INTERVAL = 5
+GAUGE_TTL = 60
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = tuple(1 << i for i in range(8, 28, 2))
+
+
+def _labels_string(labels):
+    if not labels:
+        return ''
+    items = ','.join(f'{k}="{str(v)}"' for k, v in labels)
+    return f'{{{items}}}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, description, registry):
+        self.name = name
+        self.description = description
+        self._registry = registry
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _samples(self):
+        """Local increments since the last call as {sample name: delta}"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        self._registry.ensure_flusher()
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def _samples(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return {f'{self.name}{_labels_string(labels)}': value for labels, value in values.items()}
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        self._registry.ensure_flusher()
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        samples = {}
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples[f'{self.name}_bucket{_labels_string(labels + (("le", le),))}'] = cumulative
+            samples[f'{self.name}_sum{_labels_string(labels)}'] = total
+            samples[f'{self.name}_count{_labels_string(labels)}'] = sum(counts)
+        return samples
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._functions = {}
+
+    def set_function(self, f, **labels):
+        """Evaluate f() every time the gauge is reported"""
+        self._registry.ensure_flusher()
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._functions[labels] = f
+
+    def set(self, value, **labels):
+        self._registry.ensure_flusher()
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, value=1, **labels):
+        self._registry.ensure_flusher()
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def _samples(self):
+        # Gauges are not reset, the current value is reported every time
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        values.update((labels, f()) for labels, f in functions.items())
+        return {f'{self.name}{_labels_string(labels)}': value for labels, value in values.items()}
+
+
+class Registry:
+    def __init__(self, redis_conn=None):
+        self.redis_conn = redis_conn
+        self._metrics = []
+        self._local = {}
+        self._flush_pid = None
+        self._flush_lock = threading.Lock()
+        self._worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def _metric_key(self, metric):
+        return f'{METRICS_PREFIX}:{metric.name}'
+
+    def _gauge_key(self, metric):
+        return f'{METRICS_PREFIX}:{metric.name}:{self._worker}'
+
+    def ensure_flusher(self):
+        # gunicorn forks workers, each of them needs its own flushing thread
+        pid = os.getpid()
+        if self._flush_pid == pid:
+            return
+        with self._flush_lock:
+            if self._flush_pid == pid:
+                return
+            self._worker = f'{socket.gethostname()}:{pid}'
+            thread = threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True)
+            thread.start()
+            self._flush_pid = pid
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f'Cannot flush metrics: {e!r}')
+
+    def flush(self):
+        with self._flush_lock:
+            if self.redis_conn is None:
+                for metric in self._metrics:
+                    local = self._local.setdefault(metric.name, {})
+                    for sample, value in metric._samples().items():
+                        if metric.type == 'gauge':
+                            local[sample] = value
+                        else:
+                            local[sample] = local.get(sample, 0) + value
+                return
+            pipeline = self.redis_conn.pipeline(transaction=False)
+            for metric in self._metrics:
+                samples = metric._samples()
+                if metric.type == 'gauge':
+                    if not samples:
+                        continue
+                    key = self._gauge_key(metric)
+                    pipeline.delete(key)
+                    pipeline.hset(key, mapping=samples)
+                    pipeline.expire(key, GAUGE_TTL)
+                    continue
+                for sample, value in samples.items():
+                    pipeline.hincrbyfloat(self._metric_key(metric), sample, value)
+            pipeline.execute()
+
+    def _collect(self):
+        if self.redis_conn is None:
+            return {metric.name: self._local.get(metric.name, {}) for metric in self._metrics}
+        values = {}
+        for metric in self._metrics:
+            if metric.type == 'gauge':
+                samples = {}
+                for key in self.redis_conn.scan_iter(f'{self._metric_key(metric)}:*'):
+                    worker = ':'.join(key.decode().rsplit(':', maxsplit=2)[-2:])
+                    for sample, value in self.redis_conn.hgetall(key).items():
+                        sample = sample.decode()
+                        if '{' in sample:
+                            sample = sample.replace('{', f'{{worker="{worker}",', 1)
+                        else:
+                            sample = f'{sample}{{worker="{worker}"}}'
+                        samples[sample] = value.decode()
+                values[metric.name] = samples
+            else:
+                values[metric.name] = {k.decode(): v.decode()
+                                       for k, v in self.redis_conn.hgetall(self._metric_key(metric)).items()}
+        return values
+
+    def render(self):
+        """Metrics in Prometheus text exposition format"""
+        self.flush()
+        values = self._collect()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{sample} {value}' for sample, value in sorted(values[metric.name].items()))
+        return '\n'.join(lines) + '\n'
+
+
+def _create_registry():
+    if CACHE_TYPE.lower().strip() != 'redis':
+        return Registry()
+
+    from redis import StrictRedis
+
+    from config import REDIS_HOSTNAME
+
+    return Registry(StrictRedis(REDIS_HOSTNAME))
+
+
+registry = _create_registry()
+
+
+def counter(name, description):
+    return Counter(name, description, registry)
+
+
+def histogram(name, description, buckets=LATENCY_BUCKETS):
+    return Histogram(name, description, registry, buckets=buckets)
+
+
+def gauge(name, description):
+    return Gauge(name, description, registry)
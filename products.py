@@ -4,13 +4,14 @@ from dataclasses import dataclass
 from urllib.parse import urljoin
 
 import numpy as np
-import requests
 from astropy import units
 from astropy.coordinates import SkyCoord, EarthLocation
 from astropy.time import Time
 
 from cache import cache
 from config import PRODUCTS_URL
+from upstream import service
+from util import mjd_to_iso, NotFound, CatalogUnavailable
 
 
 PALOMAR = EarthLocation.of_site('palomar')
@@ -59,11 +60,27 @@ class DateWithFrac:
         return os.path.join(self.products_path, filename)
 
 
-@cache()
+def products_roots(mjd, coord=None, location=PALOMAR):
+    """Sorted unique DateWithFrac.products_root of the MJD array, computed at once for all observations"""
+    t = Time(mjd, format='mjd', location=location)
+    if coord is not None:
+        t = t - t.light_travel_time(SkyCoord(**coord, unit=units.deg))
+    days = np.unique(np.floor(np.atleast_1d(t.mjd)))
+    return [f'/products/sci/{date[:4]}/{date[5:7]}{date[8:10]}/' for date in mjd_to_iso(days).tolist()]
+
+
+@cache('products')
 def _fracs(products_root):
     url = urljoin(PRODUCTS_URL, products_root)
-    body = requests.get(url).text
-    fracs = re.findall(r'<a href="(\d{6})/">\1/</a>', body)
+    resp = service('products').get(url)
+    # Error pages must not be cached as empty listings
+    if resp.status_code == 404:
+        raise NotFound(f'{url} is not found')
+    if resp.status_code != 200:
+        raise CatalogUnavailable(f'{url} returned {resp.status_code}')
+    fracs = re.findall(r'<a href="(\d{6})/">\1/</a>', resp.text)
+    if not fracs:
+        raise NotFound(f'{url} lists no exposures')
     return sorted(int(f) for f in fracs)
 
 
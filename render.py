@@ -0,0 +1,156 @@
+"""Rendering of downloadable figures outside of gunicorn workers
+
+A figure takes up to several seconds, PDF output runs LaTeX. Every gunicorn worker renders in a single child process
+of its own, so a stuck job is killed after RENDER_TIMEOUT and the worker survives. The number of jobs rendered at once
+by all workers of the host is bounded by RENDER_SLOTS, so the other workers are always free for Dash callbacks. A
+worker which cannot take a slot does not wait for it, RenderUnavailable is answered with 503 and Retry-After.
+Slots are locked files, the lock is released by the OS if the worker dies.
+
+Child processes are started by the forkserver with the figures module preloaded, because forking a multithreaded
+gunicorn worker is unsafe
+"""
+
+import fcntl
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from config import RENDER_SLOTS, RENDER_TIMEOUT
+from util import RenderUnavailable
+
+
+# Seconds a client should wait before the next attempt when all slots are busy
+RETRY_AFTER = 5
+
+RENDER_SECONDS = metrics.histogram('ztf_viewer_render_seconds', 'Time of figure rendering in the rendering process')
+RENDER_JOBS = metrics.gauge('ztf_viewer_render_jobs', 'Figure rendering jobs holding a slot')
+RENDER_REJECTED = metrics.counter('ztf_viewer_render_rejected_total',
+                                  'Figures not rendered because of busy slots, timeout or crashed rendering process')
+
+
+def _timed_call(f, *args, **kwargs):
+    start = time.monotonic()
+    result = f(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+class RenderSlots:
+    """Semaphore shared by all processes of the host, a slot is a file locked with flock()"""
+
+    def __init__(self, n, directory=None):
+        directory = directory or tempfile.gettempdir()
+        self.paths = [os.path.join(directory, f'ztf-viewer-render-{i}.lock') for i in range(n)]
+
+    def acquire(self):
+        """File descriptor of the locked slot or None if all slots are busy"""
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    @staticmethod
+    def release(fd):
+        os.close(fd)
+
+
+class RenderPool:
+    def __init__(self, slots, timeout):
+        self.slots = slots
+        self.timeout = timeout
+        self.jobs = 0
+        self._executor = None
+        self._worker_pid = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start_job(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self.jobs = 0
+                self._executor = None
+                self._worker_pid = None
+                self._pid = pid
+                RENDER_JOBS.set_function(lambda: self.jobs)
+            self.jobs += 1
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['figures', 'render'])
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                self._worker_pid = None
+                # The executor with a single worker never replaces its process, so the PID is asked once and the
+                # process can be killed without touching the executor internals
+                self._worker_pid = self._executor.submit(os.getpid).result(timeout=self.timeout)
+            return self._executor
+
+    def _discard(self, executor):
+        """Kill the process of the executor, the next job starts a new one"""
+        with self._lock:
+            if executor is None or self._executor is not executor:
+                return
+            self._executor = None
+            worker_pid, self._worker_pid = self._worker_pid, None
+        # ProcessPoolExecutor cannot cancel a running job, so its process is terminated and the future fails with
+        # BrokenProcessPool
+        if worker_pid is not None:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        executor.shutdown(wait=False)
+
+    def render(self, f, *args, **kwargs):
+        """Call f(*args, **kwargs) in the rendering process, f, its arguments and result must be picklable"""
+        fd = self.slots.acquire()
+        if fd is None:
+            RENDER_REJECTED.inc(reason='busy')
+            raise RenderUnavailable('All rendering slots are busy')
+        self._start_job()
+        # The slot is held until the job is finished or its process is killed, even if the request stops waiting
+        try:
+            executor = None
+            try:
+                executor = self._get_executor()
+                future = executor.submit(_timed_call, f, *args, **kwargs)
+            except (BrokenProcessPool, FutureTimeoutError) as e:
+                # The process has died between jobs or has not started
+                RENDER_REJECTED.inc(reason='crash')
+                logging.warning('Rendering process has crashed between jobs')
+                self._discard(executor or self._executor)
+                raise RenderUnavailable('Rendering process has crashed') from e
+            try:
+                result, seconds = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                RENDER_REJECTED.inc(reason='timeout')
+                logging.warning(f'{f.__name__} has not finished in {self.timeout} s, rendering process is killed')
+                self._discard(executor)
+                raise RenderUnavailable(f'Figure is not rendered in {self.timeout} s') from None
+            except BrokenProcessPool as e:
+                RENDER_REJECTED.inc(reason='crash')
+                logging.warning(f'Rendering process has crashed in {f.__name__}')
+                self._discard(executor)
+                raise RenderUnavailable('Rendering process has crashed') from e
+        finally:
+            with self._lock:
+                self.jobs -= 1
+            self.slots.release(fd)
+        RENDER_SECONDS.observe(seconds, figure=f.__name__)
+        return result
+
+
+render_pool = RenderPool(RenderSlots(RENDER_SLOTS), timeout=RENDER_TIMEOUT)
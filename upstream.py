@@ -0,0 +1,294 @@
+"""Calls of external services with timeouts, request deadlines and circuit breakers
+
+Every service has its own connect and read timeouts. A caller may set a deadline for all upstream calls made in its
+context, e.g. a Dash callback which must answer before gunicorn kills the worker, the deadline is passed to the
+tasks of ForkSafeExecutor. A circuit breaker of the service opens after several consecutive failures, calls fail
+fast with CatalogUnavailable while it is open, and a single trial call is let through after the recovery time.
+Breakers are per-process, so every gunicorn worker decides on its own.
+
+HTTP requests of all services and threads share a single keep-alive connection pool of the process, idempotent
+requests are retried after connection errors and gateway errors with jittered exponential backoff
+"""
+
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from util import CatalogUnavailable, DeadlineExceeded
+
+
+UPSTREAM_SECONDS = metrics.histogram('ztf_viewer_upstream_request_seconds', 'Time of external service calls')
+UPSTREAM_REJECTED = metrics.counter('ztf_viewer_upstream_rejected_total',
+                                    'External service calls not made because of open breaker or missed deadline')
+UPSTREAM_RETRIES = metrics.counter('ztf_viewer_upstream_retries_total', 'Retried HTTP requests to external services')
+UPSTREAM_BREAKER_OPEN = metrics.gauge('ztf_viewer_upstream_breaker_open',
+                                      'Whether the circuit breaker of the external service is open')
+
+
+@dataclass(frozen=True)
+class ServicePolicy:
+    """Timeouts are in seconds, failure_threshold is the number of consecutive failures opening the breaker,
+    recovery_time is the number of seconds before the open breaker lets a trial call through
+
+    pool_maxsize is the number of keep-alive connections to every host of the service, connections opened above it
+    are closed after use. retries is the number of retries of idempotent requests, backoff is the
+    upper bound of the first retry delay in seconds, it is doubled for every next retry
+    """
+    name: str
+    read_timeout: float
+    connect_timeout: float = 3.05
+    failure_threshold: int = 5
+    recovery_time: float = 30
+    pool_maxsize: int = 4
+    retries: int = 2
+    backoff: float = 0.2
+
+
+POLICIES = {policy.name: policy for policy in (
+    # Light curves are requested by batches and summaries of all workers threads
+    ServicePolicy('lc-api', read_timeout=30, pool_maxsize=16),
+    ServicePolicy('features', read_timeout=20),
+    # Listings are requested for every night of the light curve by the cache warmer
+    ServicePolicy('products', read_timeout=10, pool_maxsize=8),
+    ServicePolicy('vizier', read_timeout=30),
+    ServicePolicy('simbad', read_timeout=20),
+    ServicePolicy('cds', read_timeout=20),
+    ServicePolicy('tns', read_timeout=20),
+    ServicePolicy('astrocats', read_timeout=20),
+    ServicePolicy('ztf-periodic', read_timeout=10),
+    ServicePolicy('ogle', read_timeout=10),
+    # Thumbnails are downloaded concurrently, see OGLEQuery.thumbnail_workers
+    ServicePolicy('ogledb', read_timeout=10, pool_maxsize=8),
+)}
+
+RETRY_STATUSES = frozenset({502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+
+def set_deadline(seconds):
+    """Set the deadline in the current context, it can only be shortened, returns token for reset_deadline"""
+    value = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        value = min(value, current)
+    return _deadline.set(value)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline(seconds):
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(token)
+
+
+def remaining_time():
+    """Seconds before the deadline of the current context, None if there is no deadline"""
+    value = _deadline.get()
+    if value is None:
+        return None
+    return value - time.monotonic()
+
+
+class CircuitBreaker:
+    def __init__(self, policy):
+        self.policy = policy
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial or time.monotonic() - self.opened_at < self.policy.recovery_time:
+                raise CatalogUnavailable(f'{self.policy.name} is unavailable after {self.failures} failures')
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f'Circuit breaker of {self.policy.name} is closed')
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures < self.policy.failure_threshold:
+                return
+            if self.opened_at is None:
+                logging.warning(f'Circuit breaker of {self.policy.name} is open after {self.failures} failures')
+            self.opened_at = time.monotonic()
+
+    def cancel(self):
+        """Call is finished with neither success nor failure, e.g. interrupted by the deadline"""
+        with self._lock:
+            self._trial = False
+
+
+class ConnectionPool:
+    """requests.Session shared by all threads of the process with a connection pool per host
+
+    The session is re-created after fork, because sockets cannot be shared by gunicorn workers
+    """
+
+    def __init__(self):
+        self._session = None
+        self._pid = None
+        self._hosts = set()
+        self._lock = threading.Lock()
+
+    def session(self, url, pool_maxsize):
+        scheme, netloc, *_ = urlsplit(url)
+        prefix = f'{scheme}://{netloc}/'
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._session = requests.Session()
+                self._hosts = set()
+                self._pid = pid
+            if prefix not in self._hosts:
+                # Session.mount() changes adapters in place while other threads may look them up, so they are
+                # replaced at once, longer prefixes go first like mount() orders them
+                adapters = dict(self._session.adapters)
+                adapters[prefix] = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+                self._session.adapters = OrderedDict(sorted(adapters.items(), key=lambda item: -len(item[0])))
+                self._hosts.add(prefix)
+            return self._session
+
+
+pool = ConnectionPool()
+
+
+class Service:
+    def __init__(self, policy):
+        self.policy = policy
+        self.name = policy.name
+        self.breaker = CircuitBreaker(policy)
+        UPSTREAM_BREAKER_OPEN.set_function(lambda: int(self.breaker.is_open), service=self.name)
+
+    def _check_deadline(self):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            UPSTREAM_REJECTED.inc(service=self.name, reason='deadline')
+            raise DeadlineExceeded(f'No time is left to call {self.name}')
+        return remaining
+
+    def timeout(self):
+        """(connect, read) timeout for requests, read timeout is shortened to the deadline"""
+        remaining = self._check_deadline()
+        read_timeout = self.policy.read_timeout
+        if remaining is not None:
+            read_timeout = min(read_timeout, remaining)
+        return min(self.policy.connect_timeout, read_timeout), read_timeout
+
+    def call(self, f, *args, is_failure=None, **kwargs):
+        """Call f through the circuit breaker, network errors are raised as CatalogUnavailable
+
+        is_failure is an optional function of the returned value, e.g. checking if HTTP status code is 5xx
+        """
+        self._check_deadline()
+        try:
+            self.breaker.before_call()
+        except CatalogUnavailable:
+            UPSTREAM_REJECTED.inc(service=self.name, reason='breaker')
+            raise
+        start = time.monotonic()
+        try:
+            result = f(*args, **kwargs)
+        except DeadlineExceeded:
+            self.breaker.cancel()
+            UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='deadline')
+            raise
+        except (requests.RequestException, OSError) as e:
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                self.breaker.cancel()
+                UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='deadline')
+                raise DeadlineExceeded(f'{self.name} has not answered before the deadline') from e
+            self.breaker.failure()
+            UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='error')
+            logging.warning(f'{self.name} call failed: {e!r}')
+            raise CatalogUnavailable(f'{self.name} call failed: {e!r}') from e
+        except BaseException:
+            # Errors of the response handling, e.g. parsing, say nothing about availability of the service
+            self.breaker.cancel()
+            UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='error')
+            raise
+        if is_failure is not None and is_failure(result):
+            self.breaker.failure()
+            UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='error')
+        else:
+            self.breaker.success()
+            UPSTREAM_SECONDS.observe(time.monotonic() - start, service=self.name, outcome='ok')
+        return result
+
+    def _retry_delay(self, attempt):
+        """Delay before the retry or None if there is no time for it, full jitter spreads retries of many clients"""
+        delay = random.uniform(0.0, self.policy.backoff * 2 ** attempt)
+        remaining = remaining_time()
+        if remaining is not None and remaining <= delay:
+            return None
+        return delay
+
+    def _send(self, method, url, **kwargs):
+        session = pool.session(url, self.policy.pool_maxsize)
+        retries = self.policy.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            try:
+                response = session.request(method, url, timeout=self.timeout(), **kwargs)
+            except requests.ConnectionError:
+                # Connection is refused, reset or not established in time, the request has not been processed
+                if attempt >= retries or (delay := self._retry_delay(attempt)) is None:
+                    raise
+            else:
+                if (response.status_code not in RETRY_STATUSES or attempt >= retries
+                        or (delay := self._retry_delay(attempt)) is None):
+                    return response
+            UPSTREAM_RETRIES.inc(service=self.name)
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, method, url, **kwargs):
+        return self.call(self._send, method, url, is_failure=lambda response: response.status_code >= 500, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_services = {name: Service(policy) for name, policy in POLICIES.items()}
+
+
+def service(name):
+    return _services[name]
@@ -1,11 +1,15 @@
 import json
 import logging
 import math
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from itertools import chain
 
 import astropy.table
+import contextvars
 import datetime
 import numpy as np
 from astropy import units
@@ -56,6 +60,35 @@ def db_coord_to_degrees(coord):
     return ra, dec
 
 
+# Cone searches are cached for covering cones with centers snapped to a grid of such cells
+SKY_CELL_ARCSEC = 5.0
+COVERING_RADII_ARCSEC = (5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+
+
+def angular_separation_arcsec(ra1, dec1, ra2, dec2):
+    """Haversine formula, works with numpy arrays, arguments are in degrees"""
+    ra1, dec1, ra2, dec2 = (np.radians(x) for x in (ra1, dec1, ra2, dec2))
+    a = np.sin(0.5 * (dec2 - dec1))**2 + np.cos(dec1) * np.cos(dec2) * np.sin(0.5 * (ra2 - ra1))**2
+    return np.degrees(2.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))) * 3600.0
+
+
+def covering_cone(ra, dec, radius_arcsec):
+    """Cone containing the given one with the center snapped to the sky grid and the radius rounded up
+
+    Nearby cones of similar radii share the same covering cone. Returns None if the cone is too large
+    """
+    cell = SKY_CELL_ARCSEC / 3600.0
+    dec_center = min(max(round(dec / cell) * cell, -90.0), 90.0)
+    cos_dec = math.cos(math.radians(dec_center))
+    ra_step = cell / cos_dec if cos_dec > cell else 360.0
+    ra_center = (round(ra / ra_step) * ra_step) % 360.0
+    offset = float(angular_separation_arcsec(ra, dec, ra_center, dec_center))
+    for covering_radius in COVERING_RADII_ARCSEC:
+        if offset + radius_arcsec <= covering_radius:
+            return ra_center, dec_center, covering_radius
+    return None
+
+
 def hms_to_deg(hms: str):
     h, m, s = (float(x) for x in hms.split())
     angle = h * units.hourangle + m * units.arcmin + s * units.arcsec
@@ -82,7 +115,7 @@ def html_from_astropy_table(table: astropy.table.Table, columns: dict):
     ''')
     table = table[list(columns.keys())].copy()
     for column in table.colnames:
-        table[column] = [to_str(x) for x in table[column]]
+        table[column] = to_str_column(table[column])
     html = template.render(table=table, columns=columns)
     return html
 
@@ -111,6 +144,44 @@ def to_str(s):
     raise ValueError(f'Argument should be str, bytes, int, float or unit.Quantity (distance), not {type(s)}')
 
 
+def to_str_column(column):
+    """to_str() of every value of a table column, formatted column-wise for common dtypes"""
+    mask = np.ma.getmaskarray(column)
+    values = np.asarray(np.ma.getdata(column))
+    kind = values.dtype.kind
+    if kind == 'S':
+        strings = np.char.decode(values, 'utf-8')
+    elif kind == 'U':
+        strings = values
+    elif kind in 'iu':
+        strings = values.astype(str)
+    elif kind == 'f':
+        strings = np.char.mod('%.3f', values)
+        mask = mask | np.isnan(values)
+    else:
+        return np.array([to_str(x) for x in column], dtype=str)
+    return np.where(mask, '', strings)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def to_float_array(column):
+    """Values of a table column as float array, masked and non-numeric values are NaN"""
+    mask = np.ma.getmaskarray(column)
+    values = np.asarray(np.ma.getdata(column))
+    try:
+        result = values.astype(float)
+    except (TypeError, ValueError):
+        result = np.array([_to_float(x) for x in values], dtype=float)
+    result[mask] = np.nan
+    return result
+
+
 def anchor_form(url, data, title):
     inputs = '\n'.join(f'<input type="hidden" name="{key}" value="{value}">' for key, value in data.items())
     return f'''
@@ -139,6 +210,16 @@ def mjd_to_datetime(mjd):
     return dt
 
 
+# MJD of 1970-01-01
+UNIX_EPOCH_MJD = 40587
+
+
+def mjd_to_iso(mjd):
+    """Array of "YYYY-MM-DD HH:MM:SS" strings of MJD array, leap seconds are ignored"""
+    seconds = np.floor((np.asarray(mjd, dtype=float) - UNIX_EPOCH_MJD) * 86400.0).astype('datetime64[s]')
+    return np.char.replace(np.datetime_as_string(seconds, unit='s'), 'T', ' ')
+
+
 def raise_if(condition, exception):
     def decorator(f):
         @wraps(f)
@@ -158,6 +239,36 @@ class CatalogUnavailable(RuntimeError):
     pass
 
 
+class DeadlineExceeded(CatalogUnavailable):
+    """Upstream call is not made or interrupted because the time budget of the request is over"""
+
+
+class RenderUnavailable(RuntimeError):
+    """Figure is not rendered because the rendering pool is saturated or the job has not finished in time"""
+
+
+class ForkSafeExecutor:
+    """Thread pool which is created lazily in every process, because threads don't survive gunicorn fork"""
+
+    def __init__(self, max_workers, thread_name_prefix=''):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.thread_name_prefix)
+                    self._pid = pid
+        # Context variables like the upstream deadline of the request are passed to the task
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, fn, *args, **kwargs)
+
+
 def joiner(value, iterator):
     iterator = iter(iterator)
     yield next(iterator)
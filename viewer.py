@@ -1,6 +1,8 @@
+import logging
 import pathlib
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import lru_cache, partial
-from itertools import chain
 from urllib.parse import urlencode
 
 import dash_core_components as dcc
@@ -8,7 +10,6 @@ import dash_dangerously_set_inner_html as ddsih
 import dash_defer_js_import as dji
 import dash_html_components as html
 import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from dash.dependencies import Input, Output, State, ALL
@@ -19,10 +20,10 @@ from requests import ConnectionError
 from app import app
 from cross import (get_catalog_query, find_vizier, find_ztf_oid, find_ztf_circle, vizier_catalog_details,
                    light_curve_features, catalog_query_objects,)
-from data import get_plot_data, get_folded_plot_data, MJD_OFFSET
+from data import get_plot_data, get_folded_plot_data, plot_data_frame, MJD_OFFSET
 from products import DateWithFrac, correct_date
 from util import (html_from_astropy_table, to_str, INF, min_max_mjd_short, FILTER_COLORS, FILTERS, ZTF_FILTERS,
-                  NotFound, CatalogUnavailable, joiner)
+                  NotFound, CatalogUnavailable, joiner, ForkSafeExecutor)
 
 LIGHT_CURVE_TABLE_COLUMNS = ('mjd', 'mag', 'magerr', 'clrcoeff')
 
@@ -39,6 +40,31 @@ MARKER_SIZE = 10
 
 LIST_MAXSHOW = 4
 
+# Upstream queries of the summary are run concurrently, the pool is shared by all requests of the process
+SUMMARY_WORKERS = 16
+LIGHT_CURVE_FEATURES_TIMEOUT = 10
+
+summary_executor = ForkSafeExecutor(SUMMARY_WORKERS, thread_name_prefix='summary')
+
+
+def timed(name, f, *args, **kwargs):
+    start = time.monotonic()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        logging.info(f'{name} took {time.monotonic() - start:.3f}s')
+
+
+def future_result(future, name, deadline):
+    """Result of the future, NotFound if it is not ready before the deadline"""
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError as e:
+        # The query goes on if it has started and fills the cache for the next time
+        future.cancel()
+        logging.warning(f'{name} is not ready in time, skip it')
+        raise NotFound from e
+
 
 def parse_pathname(pathname):
     path = pathlib.Path(pathname)
@@ -163,7 +189,7 @@ def get_layout(pathname):
                                     [
                                         html.H4('Different passband, same field'),
                                         dcc.Input(
-                                            value='1',
+                                            value=str(find_ztf_circle.default_radius_arcsec),
                                             id='different_filter_radius',
                                             placeholder='Search radius, arcsec',
                                             type='number',
@@ -180,7 +206,7 @@ def get_layout(pathname):
                                     [
                                         html.H4('Different field'),
                                         dcc.Input(
-                                            value='1',
+                                            value=str(find_ztf_circle.default_radius_arcsec),
                                             id='different_field_radius',
                                             placeholder='Search radius, arcsec',
                                             type='number',
@@ -233,7 +259,7 @@ def get_layout(pathname):
             [
                 html.H2('GCVS'),
                 dcc.Input(
-                    value='10',
+                    value=str(get_catalog_query('gcvs').default_radius_arcsec),
                     id=dict(type='search-radius', index='gcvs'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -247,7 +273,7 @@ def get_layout(pathname):
             [
                 html.H2('VSX'),
                 dcc.Input(
-                    value='10',
+                    value=str(get_catalog_query('vsx').default_radius_arcsec),
                     id=dict(type='search-radius', index='vsx'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -261,7 +287,7 @@ def get_layout(pathname):
             [
                 html.H2('ATLAS'),
                 dcc.Input(
-                    value='10',
+                    value=str(get_catalog_query('atlas').default_radius_arcsec),
                     id=dict(type='search-radius', index='atlas'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -275,7 +301,7 @@ def get_layout(pathname):
             [
                 html.H2('ZTF Catalog of Periodic Variable Stars'),
                 dcc.Input(
-                    value='1',
+                    value=str(get_catalog_query('ztf-periodic').default_radius_arcsec),
                     id=dict(type='search-radius', index='ztf-periodic'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -292,7 +318,7 @@ def get_layout(pathname):
             [
                 html.H2('Transient Name Server'),
                 dcc.Input(
-                    value='5',
+                    value=str(get_catalog_query('transient-name-server').default_radius_arcsec),
                     id=dict(type='search-radius', index='transient-name-server'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -307,7 +333,7 @@ def get_layout(pathname):
             [
                 html.H2('Astrocats'),
                 dcc.Input(
-                    value='5',
+                    value=str(get_catalog_query('astrocats').default_radius_arcsec),
                     id=dict(type='search-radius', index='astrocats'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -322,7 +348,7 @@ def get_layout(pathname):
             [
                 html.H2('OGLE-III'),
                 dcc.Input(
-                    value='10',
+                    value=str(get_catalog_query('ogle').default_radius_arcsec),
                     id=dict(type='search-radius', index='ogle'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -338,7 +364,7 @@ def get_layout(pathname):
             [
                 html.H2('Simbad'),
                 dcc.Input(
-                    value='50',
+                    value=str(get_catalog_query('simbad').default_radius_arcsec),
                     id=dict(type='search-radius', index='simbad'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -352,7 +378,7 @@ def get_layout(pathname):
             [
                 html.H2('Gaia DR2 Distances'),
                 dcc.Input(
-                    value='1',
+                    value=str(get_catalog_query('gaia-dr2-distances').default_radius_arcsec),
                     id=dict(type='search-radius', index='gaia-dr2-distances'),
                     placeholder='Search radius, arcsec',
                     type='number',
@@ -476,18 +502,31 @@ def get_summary(oid, dr, different_filter, different_field, radius_ids, radius_v
     radii = {id['index']: float(value) for id, value in zip(radius_ids, radius_values)}
     ra, dec = find_ztf_oid.get_coord(oid, dr)
 
+    start = time.monotonic()
+    catalog_futures = {
+        catalog: summary_executor.submit(timed, query.query_name, query.find, ra, dec, radii[catalog])
+        for catalog, query in catalog_query_objects().items()
+    }
+    features_future = summary_executor.submit(timed, 'Light curve features', light_curve_features, oid, dr)
+    other_oids = neighbour_oids(different_filter, different_field)
+    lcs = timed('Plot data', get_plot_data, oid, dr, other_oids=other_oids)
+
     elements = {}
     for catalog, query in catalog_query_objects().items():
         try:
-            table = query.find(ra, dec, radii[catalog])
+            table = future_result(catalog_futures[catalog], query.query_name, start + query.timeout)
         except (NotFound, CatalogUnavailable):
             continue
         row = table[np.argmin(table['separation'])]
         for table_field, display_name in SUMMARY_FIELDS.items():
             try:
-                value = to_str(row[table_field]).strip()
+                value = row[table_field]
             except KeyError:
                 continue
+            # Distances are stored as numbers with the column unit
+            if table_field == '__distance' and not np.ma.is_masked(value):
+                value = value * table[table_field].unit
+            value = to_str(value).strip()
             if value == '':
                 continue
 
@@ -510,7 +549,7 @@ def get_summary(oid, dr, different_filter, different_field, radius_ids, radius_v
                 style={'display': 'inline'},
             ))
     try:
-        features = light_curve_features(oid, dr)
+        features = future_result(features_future, 'Light curve features', start + LIGHT_CURVE_FEATURES_TIMEOUT)
         el = elements.setdefault('Period, days', [])
         el.insert(0, html.Div(
             [
@@ -524,15 +563,13 @@ def get_summary(oid, dr, different_filter, different_field, radius_ids, radius_v
             ],
             style={'display': 'inline'},
         ))
-    except NotFound:
+    except (NotFound, CatalogUnavailable):
         pass
 
-    other_oids = neighbour_oids(different_filter, different_field)
-    lcs = get_plot_data(oid, dr, other_oids=other_oids)
     mags = {}
-    for obs in chain.from_iterable(lcs.values()):
-        mags.setdefault(obs['filter'], []).append(obs['mag'])
-    mean_mag = {fltr: np.mean(m) for fltr, m in mags.items()}
+    for lc in lcs.values():
+        mags.setdefault(lc.meta['filter'], []).append(lc['mag'])
+    mean_mag = {fltr: np.mean(np.concatenate(m)) for fltr, m in mags.items()}
     elements['Average mag (including neighbourhood)'] = [f'{fltr} {mean_mag[fltr]: .2f}'
                                                          for fltr in ZTF_FILTERS
                                                          if fltr in mean_mag]
@@ -606,14 +643,14 @@ def set_figure(cur_oid, dr, different_filter, different_field, min_mjd, max_mjd,
         lcs = get_folded_plot_data(cur_oid, dr, period=period, other_oids=other_oids, min_mjd=min_mjd, max_mjd=max_mjd)
     else:
         raise ValueError(f'{lc_type = } is unknown')
-    lcs = list(chain.from_iterable(lcs.values()))
-    mag_min = min(obs['mag'] - obs['magerr'] for obs in lcs)
-    mag_max = max(obs['mag'] + obs['magerr'] for obs in lcs)
+    df = plot_data_frame(lcs)
+    mag_min = (df['mag'] - df['magerr']).min()
+    mag_max = (df['mag'] + df['magerr']).max()
     mag_ampl = mag_max - mag_min
     range_y = [mag_max + 0.1 * mag_ampl, mag_min - 0.1 * mag_ampl]
     if lc_type == 'full':
         figure = px.scatter(
-            pd.DataFrame.from_records(lcs),
+            df,
             x=f'mjd_{MJD_OFFSET}',
             y='mag',
             error_y='magerr',
@@ -629,7 +666,7 @@ def set_figure(cur_oid, dr, different_filter, different_field, min_mjd, max_mjd,
         )
     elif lc_type == 'folded':
         figure = px.scatter(
-            pd.DataFrame.from_records(lcs),
+            df,
             x='phase',
             y='mag',
             error_y='magerr',
@@ -710,7 +747,8 @@ app.callback(
 def find_neighbours(radius, center_oid, dr, different):
     if radius is None:
         return html.P('No radius is specified')
-    if float(radius) <= 0:
+    radius = float(radius)
+    if radius <= 0:
         return html.P('Radius should be positive')
     ra, dec = find_ztf_oid.get_coord(center_oid, dr)
     kwargs = dict(ra=ra, dec=dec, radius_arcsec=radius, dr=dr)
@@ -889,7 +927,7 @@ def set_vizier_list(n_clicks, radius, oid, dr):
     for catalog, table in zip(table_list.keys(), table_list.values()):
         try:
             description = vizier_catalog_details.description(catalog)
-        except NotFound:
+        except (NotFound, CatalogUnavailable):
             description = catalog
         n = len(table)
         n_objects = str(n) if n < find_vizier.row_limit else f'≥{n}'
@@ -926,7 +964,7 @@ def set_vizier_list(n_clicks, radius, oid, dr):
 def set_features_list(oid, dr, min_mjd, max_mjd):
     try:
         features = light_curve_features(oid, dr, min_mjd=min_mjd, max_mjd=max_mjd)
-    except NotFound:
+    except (NotFound, CatalogUnavailable):
         return 'Not available'
     items = [f'**{k}**: {v:.4g}' for k, v in sorted(features.items(), key=lambda item: item[0])]
     column_width = max(map(len, items)) - 2
@@ -947,4 +985,4 @@ def set_features_list(oid, dr, min_mjd, max_mjd):
     ]
 )
 def set_lc_table(oid, dr, min_mjd, max_mjd):
-    return find_ztf_oid.get_lc(oid, dr, min_mjd=min_mjd, max_mjd=max_mjd)
+    return find_ztf_oid.get_lc(oid, dr, min_mjd=min_mjd, max_mjd=max_mjd).to_records(LIGHT_CURVE_TABLE_COLUMNS)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Fill the cache with everything the viewer page needs for a list of objects
+
+Input file has one object per line: either ZTF OID or "ra dec" pair in degrees, the objects inside the default
+search radius around the coordinates are warmed. Empty lines and lines starting with # are ignored.
+Finished lines are appended to the state file, so an interrupted run can be restarted with the same arguments
+"""
+
+import importer
+
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from cross import find_ztf_oid, find_ztf_circle, light_curve_features, catalog_query_objects
+from products import products_roots, _fracs
+from util import available_drs, default_dr, NotFound, CatalogUnavailable, INF
+
+
+class Warmer:
+    def __init__(self, dr):
+        self.dr = dr
+        self._products_roots = set()
+        self._products_lock = threading.Lock()
+
+    def __call__(self, line):
+        fields = line.split()
+        if len(fields) == 1:
+            self.warm_oid(int(fields[0]))
+        elif len(fields) == 2:
+            self.warm_coord(float(fields[0]), float(fields[1]))
+        else:
+            raise ValueError(f'Line should be either OID or "ra dec" pair: {line}')
+
+    def warm_coord(self, ra, dec):
+        try:
+            j = find_ztf_circle.find(ra, dec, find_ztf_circle.default_radius_arcsec, self.dr)
+        except NotFound:
+            return
+        for oid in j:
+            self.warm_oid(int(oid))
+
+    def warm_oid(self, oid):
+        try:
+            find_ztf_oid.find(oid, self.dr)
+        except NotFound:
+            logging.info(f'{oid} is not found in {self.dr}')
+            return
+        ra, dec = find_ztf_oid.get_coord(oid, self.dr)
+        # The page asks for the full light curve features, the summary asks with the default arguments
+        for kwargs in (dict(min_mjd=-INF, max_mjd=INF), dict()):
+            try:
+                light_curve_features(oid, self.dr, **kwargs)
+            except NotFound:
+                pass
+            except CatalogUnavailable as e:
+                logging.warning(f'Features of {oid} are not warmed: {e!r}')
+        # An unavailable service, e.g. TNS without API key, is skipped and the other ones are warmed
+        for name, query in catalog_query_objects().items():
+            try:
+                query.find(ra, dec, query.default_radius_arcsec)
+            except NotFound:
+                pass
+            except CatalogUnavailable as e:
+                logging.warning(f'{name} is not warmed for {oid}: {e!r}')
+        try:
+            find_ztf_circle.find(ra, dec, find_ztf_circle.default_radius_arcsec, self.dr)
+        except NotFound:
+            pass
+        except CatalogUnavailable as e:
+            logging.warning(f'Neighbours of {oid} are not warmed: {e!r}')
+        self.warm_products(oid, ra, dec)
+
+    def warm_products(self, oid, ra, dec):
+        roots = set(products_roots(find_ztf_oid.get_lc(oid, self.dr)['mjd'], coord=dict(ra=ra, dec=dec)))
+        with self._products_lock:
+            roots -= self._products_roots
+            self._products_roots |= roots
+        for root in sorted(roots):
+            try:
+                _fracs(root)
+            except (NotFound, CatalogUnavailable) as e:
+                logging.warning(f'Products listing {root} is not warmed: {e!r}')
+
+
+def read_lines(path):
+    with open(path) as fh:
+        lines = (line.strip() for line in fh)
+        return [line for line in lines if line and not line.startswith('#')]
+
+
+def read_state(path):
+    try:
+        return set(read_lines(path))
+    except FileNotFoundError:
+        return set()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='file with OIDs or "ra dec" pairs')
+    parser.add_argument('--dr', default=default_dr, choices=available_drs, help='ZTF data release')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='number of objects warmed simultaneously')
+    parser.add_argument('--state', default=None, help='file with finished lines, default is INPUT.DR.done')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='seconds between progress reports')
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    state_path = args.state or f'{args.input}.{args.dr}.done'
+
+    done = read_state(state_path)
+    lines = [line for line in read_lines(args.input) if line not in done]
+    total = len(lines)
+    logging.info(f'{len(done)} lines are already done, {total} lines to warm')
+
+    warmer = Warmer(args.dr)
+    finished = failed = 0
+    start = last_report = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - start
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        eta = (total - finished - failed) / rate if rate > 0 else INF
+        logging.info(f'{finished}/{total} done, {failed} failed, {rate:.2f} objects/s, ETA {eta:.0f} s')
+
+    with open(state_path, 'a') as state, ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        def collect(futures):
+            nonlocal finished, failed, last_report
+            completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                line = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    logging.warning(f'Cannot warm "{line}": {e!r}')
+                    continue
+                finished += 1
+                state.write(f'{line}\n')
+                state.flush()
+            if time.monotonic() - last_report >= args.progress_interval:
+                last_report = time.monotonic()
+                report()
+
+        # Only a few lines are in flight so the input file may be arbitrarily long
+        futures = {}
+        for line in lines:
+            if len(futures) >= 2 * args.jobs:
+                collect(futures)
+            futures[executor.submit(warmer, line)] = line
+        while futures:
+            collect(futures)
+
+    report()
+
+
+if __name__ == '__main__':
+    main()